@@ -20,10 +20,18 @@ import os
 import re
 import csv
 import sys
+import json
+import hashlib
+import concurrent.futures
+from collections import defaultdict
 from pathlib import Path
 from datetime import datetime
 from typing import List, Dict, Optional, Tuple
 
+RECEIPT_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.pdf')
+AUDIT_CACHE_NAME = os.path.join('.cache', 'audit_hashes.json')
+HASH_CHUNK_SIZE = 1024 * 1024
+
 class ReceiptExtractor:
     def __init__(self, base_dir: str):
         self.base_dir = Path(base_dir)
@@ -82,6 +90,20 @@ class ReceiptExtractor:
             'filename': filename
         }, reasons
 
+    @staticmethod
+    def in_period(info: Dict[str, str], year: int = None, month: int = None) -> bool:
+        """指定年・月に含まれるか（日付が不明な場合は含める）"""
+        if year or month:
+            try:
+                date = datetime.strptime(info['date'], '%Y-%m-%d')
+                if year and date.year != year:
+                    return False
+                if month and date.month != month:
+                    return False
+            except Exception:
+                pass
+        return True
+
     def get_receipts(self, year: int = None, month: int = None) -> List[Tuple[Dict[str, str], List[str]]]:
         """指定年・月のレシート情報を取得（指定がなければ全件）"""
         receipts = []
@@ -90,15 +112,8 @@ class ReceiptExtractor:
                 if filename.lower().endswith(('.jpg', '.jpeg', '.png', '.pdf')):
                     info, reasons = self.extract_info(filename)
                     # 年・月フィルタ
-                    if year or month:
-                        try:
-                            date = datetime.strptime(info['date'], '%Y-%m-%d')
-                            if year and date.year != year:
-                                continue
-                            if month and date.month != month:
-                                continue
-                        except Exception:
-                            pass
+                    if not self.in_period(info, year, month):
+                        continue
                     receipts.append((info, reasons))
             
             # 日付順にソート（不明な日付は最後に表示）
@@ -140,6 +155,156 @@ class ReceiptExtractor:
             print(f"エラー: CSVの出力中にエラーが発生しました: {e}", file=sys.stderr)
             raise
 
+class ReceiptAuditor:
+    """アーカイブ全体から重複・類似ファイルを検出する"""
+
+    def __init__(self, extractor: ReceiptExtractor, max_workers: Optional[int] = None):
+        self.extractor = extractor
+        self.base_dir = extractor.base_dir
+        self.max_workers = max_workers or min(32, (os.cpu_count() or 1) * 4)
+        self.cache_path = self.base_dir / AUDIT_CACHE_NAME
+        self.hash_cache = self._load_cache()
+
+    def _load_cache(self) -> Dict[str, Dict]:
+        try:
+            with open(self.cache_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            print(f"警告: ハッシュキャッシュの読み込みに失敗しました: {e}", file=sys.stderr)
+            return {}
+
+    def _save_cache(self):
+        try:
+            self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+            temp_path = self.cache_path.with_suffix('.tmp')
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.hash_cache, f, ensure_ascii=False)
+            os.replace(temp_path, self.cache_path)
+        except Exception as e:
+            print(f"警告: ハッシュキャッシュの保存に失敗しました: {e}", file=sys.stderr)
+
+    def scan_files(self) -> List[Tuple[Path, os.stat_result]]:
+        """レシートファイルを再帰的に列挙（バックアップとキャッシュのディレクトリは除外）"""
+        files = []
+        for root, dirs, filenames in os.walk(self.base_dir):
+            dirs[:] = [d for d in dirs if not d.startswith(('backup_', '.'))]
+            for filename in filenames:
+                if filename.lower().endswith(RECEIPT_EXTENSIONS):
+                    path = Path(root) / filename
+                    try:
+                        files.append((path, path.stat()))
+                    except OSError as e:
+                        # リンク切れのシンボリックリンクや走査中に削除されたファイルは飛ばす
+                        print(f"警告: ファイル情報を取得できないためスキップします: {path}: {e}", file=sys.stderr)
+        return files
+
+    def _hash_file(self, path: Path, stat: os.stat_result) -> str:
+        """SHA-256を計算（パス・サイズ・更新時刻が同じならキャッシュを使う）"""
+        key = str(path.relative_to(self.base_dir))
+        cached = self.hash_cache.get(key)
+        if cached and cached['size'] == stat.st_size and cached['mtime'] == stat.st_mtime:
+            return cached['sha256']
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                digest.update(chunk)
+        self.hash_cache[key] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha256': digest.hexdigest()}
+        return digest.hexdigest()
+
+    def find_exact_duplicates(self, files: List[Tuple[Path, os.stat_result]]) -> List[List[Path]]:
+        """内容が完全に一致するファイルのグループ（サイズが重複するものだけハッシュを計算）"""
+        # 削除・移動されたファイルのキャッシュは破棄する
+        existing = {str(path.relative_to(self.base_dir)) for path, _ in files}
+        self.hash_cache = {key: value for key, value in self.hash_cache.items() if key in existing}
+
+        by_size = defaultdict(list)
+        for path, stat in files:
+            by_size[stat.st_size].append((path, stat))
+        candidates = [item for group in by_size.values() if len(group) > 1 for item in group]
+
+        by_hash = defaultdict(list)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(self._hash_file, path, stat): path for path, stat in candidates}
+            for future in concurrent.futures.as_completed(futures):
+                path = futures[future]
+                try:
+                    by_hash[future.result()].append(path)
+                except Exception as e:
+                    print(f"警告: ハッシュの計算に失敗しました: {path}: {e}", file=sys.stderr)
+        self._save_cache()
+        return [sorted(group) for group in by_hash.values() if len(group) > 1]
+
+    def find_same_info_clusters(self, files: List[Tuple[Path, os.stat_result]],
+                                year: int = None, month: int = None) -> List[List[Tuple[Dict[str, str], Path]]]:
+        """日付・金額・支払先が同じファイルのグループ（連番の「_N」は無視する）"""
+        clusters = defaultdict(list)
+        for path, _ in files:
+            info, reasons = self.extractor.extract_info(path.name)
+            if reasons or not self.extractor.in_period(info, year, month):
+                continue
+            payee = re.sub(r'_\d+$', '', info['payee'])
+            clusters[(info['date'], info['amount'], payee)].append((info, path))
+        return [sorted(group, key=lambda item: item[1]) for group in clusters.values() if len(group) > 1]
+
+    def find_numbered_siblings(self, files: List[Tuple[Path, os.stat_result]]) -> List[List[Path]]:
+        """同じディレクトリ内の「_N」連番付きファイルと元のファイルのグループ
+
+        receipt_rename.py が連番を付けるのは確定申告フォーマットのファイル名だけなので、
+        その形式のファイルに限り、連番のない元のファイルが存在する場合のみ報告する
+        （IMG_0001.jpg などのカメラやスキャナの連番を誤検出しないため）。
+        """
+        groups = defaultdict(list)
+        for path, _ in files:
+            if not self.extractor.pattern.match(path.name):
+                continue
+            match = re.match(r'^(.*)_(\d+)$', path.stem)
+            stem = match.group(1) if match else path.stem
+            groups[(path.parent, stem, path.suffix.lower())].append(path)
+        return [sorted(group) for (_, stem, _), group in groups.items()
+                if len(group) > 1 and any(p.stem == stem for p in group)]
+
+    def print_report(self, year: int = None, month: int = None):
+        """監査結果をCSVで標準出力に出力"""
+        files = self.scan_files()
+        duplicates = self.find_exact_duplicates(files)
+        clusters = self.find_same_info_clusters(files, year, month)
+        siblings = self.find_numbered_siblings(files)
+
+        writer = csv.DictWriter(sys.stdout, fieldnames=['kind', 'group', 'date', 'amount', 'payee', 'filename'])
+        writer.writeheader()
+        group_id = 0
+
+        def write_group(kind, paths):
+            for path in paths:
+                info, _ = self.extractor.extract_info(path.name)
+                writer.writerow({
+                    'kind': kind,
+                    'group': group_id,
+                    'date': info['date'],
+                    'amount': info['amount'],
+                    'payee': info['payee'],
+                    'filename': str(path.relative_to(self.base_dir)),
+                })
+
+        for group in duplicates:
+            group_id += 1
+            write_group('exact_duplicate', group)
+        for group in clusters:
+            group_id += 1
+            write_group('same_date_amount_payee', [path for _, path in group])
+        for group in siblings:
+            group_id += 1
+            write_group('numbered_sibling', group)
+
+        print("\n=== 監査結果 ===", file=sys.stderr)
+        print(f"対象ファイル数: {len(files)}", file=sys.stderr)
+        print(f"完全一致の重複: {len(duplicates)}グループ", file=sys.stderr)
+        print(f"日付・金額・支払先が同じ: {len(clusters)}グループ", file=sys.stderr)
+        print(f"連番付きファイル: {len(siblings)}グループ", file=sys.stderr)
+        print("================", file=sys.stderr)
+
 def main():
     import argparse
 
@@ -148,12 +313,18 @@ def main():
     parser.add_argument('--month', type=int, help='対象月（省略時は全件）')
     parser.add_argument('--input-dir', type=str, required=True, help='レシートファイルが直接格納されているディレクトリのパス')
     parser.add_argument('--show-unknown', action='store_true', help='不明なファイル名を表示')
+    parser.add_argument('--audit', action='store_true', help='サブディレクトリを含めて重複・類似ファイルを検出する')
+    parser.add_argument('--workers', type=int, help='監査時にハッシュを計算する並列数')
     args = parser.parse_args()
 
     try:
         input_dir = os.path.expanduser(args.input_dir)
         extractor = ReceiptExtractor(input_dir)
 
+        if args.audit:
+            ReceiptAuditor(extractor, args.workers).print_report(year=args.year, month=args.month)
+            sys.exit(0)
+
         receipts = extractor.get_receipts(year=args.year, month=args.month)
 
         if not receipts:
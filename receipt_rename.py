@@ -23,23 +23,38 @@ import csv
 from datetime import datetime
 import base64
 import json
-import pandas as pd
-from pdf2image import convert_from_path
 import tempfile
 import logging
 import argparse
 import shutil
-from PIL import Image
+import filecmp
 import time
 import re
 import multiprocessing
 import concurrent.futures
+import threading
+import functools
+import socket
+import sqlite3
+import uuid
+import hashlib
+import random
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
 from urllib import request, error
 
+# 画像・PDF処理とLLMのライブラリは読み込みに時間がかかるため、実際にファイルを処理する場合のみ
+# load_processing_modules で読み込む（常駐プロセスに処理を依頼するだけの場合は標準ライブラリのみ）
+pd = None
+convert_from_path = None
+pdfinfo_from_path = None
+Image = None
+genai = None
+
 try:
-    import google.generativeai as genai
-except Exception:
-    genai = None
+    import fcntl
+except ImportError:
+    fcntl = None
 
 LLM_PROVIDER = None
 LLM_BASE_URL = None
@@ -48,6 +63,81 @@ OPENWEBUI_TOKEN = None
 LLM_TEMPERATURE = 0.0
 LLM_MAX_TOKENS = 200
 LLM_TIMEOUT_SECONDS = 60
+LLM_MAX_CONCURRENCY = 16
+LLM_LIMITER = None
+# テキスト抽出時のコンテキスト長（None の場合はOCRテキストを切り詰めない）
+# ローカルLLMのみ既定で制限し、長いコンテキストを扱えるGeminiには全文を送る
+LLM_CONTEXT_TOKENS = None
+LOCAL_LLM_CONTEXT_TOKENS = 8192
+LLM_OCR_MAX_TOKENS = 2048
+GEMINI_MODEL = "gemini-1.5-flash"
+
+# LLM同時実行数の自動調整（AIMD）の設定
+# 応答時間は出力長や画像サイズで1件ごとに大きくばらつくため、直近の平滑化した応答時間を
+# 単独リクエストの応答時間から作った基準と比べる（種類ごとに、基準が数件分集まるまでは判定しない）
+LATENCY_TOLERANCE = 2.0
+LATENCY_SHORT_ALPHA = 0.2
+LATENCY_LONG_ALPHA = 0.02
+LATENCY_WARMUP_SAMPLES = 5
+
+_gemini_models = {}
+_gemini_model_lock = threading.Lock()
+
+# 実行全体の期限（main で設定）と、処理中のファイルの期限（スレッドごと）
+_run_deadline = None
+_deadline_local = threading.local()
+CANCEL_POLL_INTERVAL_SECONDS = 0.2
+UNFINISHED_LIST_NAME = "receipt_unfinished.txt"
+
+# メモリ見積もり用の定数（pdf2image の既定解像度と一般的なJPEG圧縮率）
+PDF_RENDER_DPI = 200
+JPEG_COMPRESSION_RATIO = 10
+DEFAULT_MEMORY_BUDGET_MB = 2048
+CGROUP_MEMORY_LIMIT_FILES = (
+    "/sys/fs/cgroup/memory.max",                    # cgroup v2
+    "/sys/fs/cgroup/memory/memory.limit_in_bytes",  # cgroup v1
+)
+CGROUP_UNLIMITED_THRESHOLD = 1 << 60
+
+# 処理コスト見積もり用の定数（OCR 1ページ分を 1.0 とした相対値）
+STRUCTURED_STAGE_COST = 0.3
+REFERENCE_PAGE_PIXELS = 1654 * 2339  # A4 @ 200dpi
+FAST_LANE_WORKERS = 2
+PDF_INFO_CACHE_SIZE = 1024
+
+# 複数ノード処理用のリース設定
+DEFAULT_LEASE_DB_NAME = ".receipt_leases.sqlite"
+DEFAULT_LEASE_TTL_SECONDS = 300
+
+# 複数の領収書をまとめてテキスト抽出する設定
+DEFAULT_BATCH_MAX_TOKENS = 6000
+BATCH_MAX_FILES = 20
+BATCH_LINGER_SECONDS = 2.0
+BATCH_RESPONSE_TOKENS_PER_FILE = 80
+
+# 常駐（デーモン）モードの設定
+DEFAULT_DAEMON_HOST = "127.0.0.1"
+DEFAULT_DAEMON_PORT = 8765
+DEFAULT_UPLOAD_DIR = "~/.cache/receipt_rename/uploads"
+DAEMON_POLL_INTERVAL_SECONDS = 0.5
+DAEMON_JOB_RETENTION_SECONDS = 3600
+LOOPBACK_HOSTS = ("127.0.0.1", "::1", "localhost")
+DAEMON_MAX_UPLOAD_BYTES = 50 * 1024 * 1024
+# ブラウザが事前確認（CORSプリフライト）なしで送れない Content-Type のみ受け付ける
+DAEMON_JSON_CONTENT_TYPE = "application/json"
+DAEMON_UPLOAD_CONTENT_TYPES = ("application/octet-stream", "application/pdf", "image/jpeg", "image/png")
+
+# 類似（重複の可能性がある）領収書の検出設定
+SIMILARITY_INDEX_NAME = os.path.join(".cache", "similarity_index.json")
+DEFAULT_DAEMON_SIMILARITY_INDEX = "~/.cache/receipt_rename/similarity_index.json"
+IMAGE_HASH_MAX_DISTANCE = 6
+TEXT_SIMILARITY_THRESHOLD = 0.85
+MINHASH_PERMUTATIONS = 64
+MINHASH_SHINGLE_SIZE = 4
+_MERSENNE_PRIME = (1 << 61) - 1
+_rng = random.Random(20240101)
+MINHASH_PARAMS = [(_rng.randrange(1, _MERSENNE_PRIME), _rng.randrange(0, _MERSENNE_PRIME))
+                  for _ in range(MINHASH_PERMUTATIONS)]
 
 def parse_arguments():
     parser = argparse.ArgumentParser(
@@ -62,6 +152,7 @@ def parse_arguments():
   %(prog)s -y 2024 -- receipt.jpg
   %(prog)s --year 2024 2025 -- *.jpg
   %(prog)s receipt1.jpg receipt2.jpg receipt3.pdf
+  %(prog)s --serve
         '''
     )
     parser.add_argument('--', dest='ignored', action='store_true', help=argparse.SUPPRESS)
@@ -69,8 +160,43 @@ def parse_arguments():
     parser.add_argument('--verbose', '-v', action='store_true', help='詳細な出力を表示する')
     parser.add_argument('--no-text', action='store_true', help='テキストファイルを保存しない')
     parser.add_argument('--year', '-y', type=int, nargs='+', help='処理対象の年を指定（例：2024 2025）')
-    parser.add_argument('file_paths', nargs='+', help='処理する領収書ファイルまたはディレクトリのパス（複数指定可）')
-    return parser.parse_args()
+    parser.add_argument('--memory-budget', type=int, metavar='MB',
+                        help='並列処理中の推定メモリ使用量の上限（MB、省略時は物理メモリとコンテナのメモリ上限の小さい方の半分）')
+    parser.add_argument('--distributed', action='store_true',
+                        help='共有ディレクトリを複数ノードで処理する（リースで処理権を排他制御）')
+    parser.add_argument('--lease-db', type=str,
+                        help=f'リースを管理するSQLiteファイル（省略時は対象ディレクトリの {DEFAULT_LEASE_DB_NAME}）')
+    parser.add_argument('--lease-ttl', type=int, default=DEFAULT_LEASE_TTL_SECONDS, metavar='SECONDS',
+                        help=f'リースの有効期間（秒、既定 {DEFAULT_LEASE_TTL_SECONDS}）')
+    parser.add_argument('--node-id', type=str, help='このノードの識別子（省略時は ホスト名:PID）')
+    parser.add_argument('--dedup', action='store_true',
+                        help='処理済みの領収書と類似するファイルを重複の可能性として検出し、抽出結果を再利用する')
+    parser.add_argument('--dedup-index', type=str,
+                        help=f'類似検索インデックスの保存先（省略時は対象ディレクトリの {SIMILARITY_INDEX_NAME}）')
+    parser.add_argument('--batch-extract', action='store_true',
+                        help='OCR後のテキスト抽出を複数ファイル分まとめて1回のリクエストで行う')
+    parser.add_argument('--batch-max-tokens', type=int, default=DEFAULT_BATCH_MAX_TOKENS, metavar='TOKENS',
+                        help=f'まとめて送るリクエストの推定トークン数の上限（既定 {DEFAULT_BATCH_MAX_TOKENS}）')
+    parser.add_argument('--file-timeout', type=float, metavar='SECONDS',
+                        help='1ファイルあたりの処理時間の上限（秒）')
+    parser.add_argument('--deadline', type=float, metavar='SECONDS',
+                        help='実行全体の処理時間の上限（秒）。超過した時点で処理中のファイルを中断する')
+    parser.add_argument('--serve', action='store_true', help='常駐モードで起動し、ローカルHTTP APIで処理を受け付ける')
+    parser.add_argument('--daemon-host', type=str, default=DEFAULT_DAEMON_HOST,
+                        help=f'常駐モードの待ち受けアドレス（既定 {DEFAULT_DAEMON_HOST}）')
+    parser.add_argument('--daemon-port', type=int,
+                        default=int(os.environ.get("RECEIPT_DAEMON_PORT", DEFAULT_DAEMON_PORT)),
+                        help=f'常駐モードのポート番号（既定 {DEFAULT_DAEMON_PORT}）')
+    parser.add_argument('--upload-dir', type=str, default=DEFAULT_UPLOAD_DIR,
+                        help=f'常駐モードでアップロードされたファイルの保存先（既定 {DEFAULT_UPLOAD_DIR}）')
+    parser.add_argument('--daemon-allow-remote', action='store_true',
+                        help='ローカルホスト以外での待ち受けを許可する（認証がないため信頼できるネットワークでのみ使用）')
+    parser.add_argument('--no-daemon', action='store_true', help='常駐プロセスが起動していても使用せずに処理する')
+    parser.add_argument('file_paths', nargs='*', help='処理する領収書ファイルまたはディレクトリのパス（複数指定可）')
+    args = parser.parse_args()
+    if not args.serve and not args.file_paths:
+        parser.error('処理するファイルまたはディレクトリを指定してください')
+    return args
 
 def setup_logging(debug=False, verbose=False):
     level = logging.DEBUG if debug else (logging.INFO if verbose else logging.WARNING)
@@ -124,14 +250,36 @@ def load_secret_from_file(secret_path, key_name):
         return None
     return None
 
+def load_processing_modules():
+    """ファイル処理に必要なライブラリを読み込む"""
+    global pd, convert_from_path, pdfinfo_from_path, Image, genai
+    import pandas as pd
+    from pdf2image import convert_from_path, pdfinfo_from_path
+    from PIL import Image
+    try:
+        import google.generativeai as genai
+    except Exception:
+        genai = None
+
 def initialize_llm(logger):
     global LLM_PROVIDER, LLM_BASE_URL, LLM_MODEL, OPENWEBUI_TOKEN
     global LLM_TEMPERATURE, LLM_MAX_TOKENS, LLM_TIMEOUT_SECONDS
+    global LLM_MAX_CONCURRENCY, LLM_LIMITER
+    global LLM_CONTEXT_TOKENS, LLM_OCR_MAX_TOKENS
 
     LLM_PROVIDER = os.environ.get("LLM_PROVIDER", "gemini").strip().lower()
     LLM_TEMPERATURE = float(os.environ.get("LLM_TEMPERATURE", "0"))
     LLM_MAX_TOKENS = int(os.environ.get("LLM_MAX_TOKENS", "200"))
     LLM_TIMEOUT_SECONDS = int(os.environ.get("LLM_TIMEOUT_SECONDS", "60"))
+    LLM_MAX_CONCURRENCY = max(int(os.environ.get("LLM_MAX_CONCURRENCY", "16")), 1)
+    LLM_LIMITER = AdaptiveConcurrencyLimiter(LLM_MAX_CONCURRENCY, logger)
+    context_tokens = os.environ.get("LLM_CONTEXT_TOKENS")
+    if context_tokens:
+        LLM_CONTEXT_TOKENS = int(context_tokens)
+    elif LLM_PROVIDER in ("openwebui", "local-llm", "local_llm"):
+        LLM_CONTEXT_TOKENS = LOCAL_LLM_CONTEXT_TOKENS
+    LLM_OCR_MAX_TOKENS = int(os.environ.get("LLM_OCR_MAX_TOKENS", "2048"))
+    logger.info(f"プロンプト: version={PROMPT_VERSION}")
 
     if LLM_PROVIDER in ("openwebui", "local-llm", "local_llm"):
         LLM_BASE_URL = (
@@ -174,11 +322,228 @@ def initialize_llm(logger):
     logger.error(f"未対応の LLM_PROVIDER です: {LLM_PROVIDER}")
     sys.exit(1)
 
-def call_openwebui_chat(messages, logger):
+class ProcessingCancelled(Exception):
+    """処理時間の上限に達したか、中断が要求された"""
+
+class LeaseLost(ProcessingCancelled):
+    """処理中のファイルのリースを他のノードに奪われた（そのノードが処理を引き継ぐ）"""
+
+class Deadline:
+    """処理の期限と中断要求を管理する（親の期限と中断要求も合わせて判定する）"""
+
+    def __init__(self, seconds=None, parent=None):
+        self.expires_at = time.monotonic() + seconds if seconds else None
+        self.parent = parent
+        self.cancelled = threading.Event()
+        self.cancel_error = None
+        self.unfinished = []
+        self._lock = threading.Lock()
+
+    def remaining(self):
+        """残り時間（秒）。期限がない場合は None"""
+        candidates = []
+        if self.expires_at is not None:
+            candidates.append(self.expires_at - time.monotonic())
+        if self.parent is not None and self.parent.remaining() is not None:
+            candidates.append(self.parent.remaining())
+        return min(candidates) if candidates else None
+
+    def check(self):
+        if self.cancelled.is_set():
+            raise self.cancel_error or ProcessingCancelled("中断が要求されました")
+        if self.parent is not None:
+            self.parent.check()
+        remaining = self.remaining()
+        if remaining is not None and remaining <= 0:
+            raise ProcessingCancelled("処理時間の上限に達しました")
+
+    def cancel(self, error=None):
+        """中断を要求する（子の期限にも伝わる）。error は check で送出する例外"""
+        self.cancel_error = error
+        self.cancelled.set()
+
+    def is_cancelled(self):
+        return self.cancelled.is_set() or (self.parent is not None and self.parent.is_cancelled())
+
+    def expired(self):
+        remaining = self.remaining()
+        return self.is_cancelled() or (remaining is not None and remaining <= 0)
+
+    def bound(self, timeout):
+        """タイムアウトを残り時間以内に制限する"""
+        remaining = self.remaining()
+        return timeout if remaining is None else max(min(timeout, remaining), 0.1)
+
+    def record_unfinished(self, file_path):
+        """未完了のファイルを実行全体の期限に記録する"""
+        root = self
+        while root.parent is not None:
+            root = root.parent
+        with root._lock:
+            root.unfinished.append(file_path)
+
+def current_deadline():
+    return getattr(_deadline_local, 'deadline', None)
+
+def llm_timeout():
+    """LLM呼び出しのタイムアウト（処理中のファイルの残り時間以内）"""
+    deadline = current_deadline()
+    return deadline.bound(LLM_TIMEOUT_SECONDS) if deadline else LLM_TIMEOUT_SECONDS
+
+def run_cancellable(func, *args, **kwargs):
+    """期限切れや中断要求があれば、完了を待たずに ProcessingCancelled を送出する
+
+    呼び出し自体は別スレッドで実行し、そのタイムアウトも残り時間以内に制限する。
+    送信済みのHTTPリクエストを取り消すことはできないため、待つのをやめる（見捨てる）だけで、
+    リクエスト自体はタイムアウトまでバックグラウンドで続き、その間はLLMの同時実行枠を使う。
+    """
+    deadline = current_deadline()
+    if deadline is None:
+        return func(*args, **kwargs)
+    deadline.check()
+
+    outcome = {}
+    done = threading.Event()
+
+    def target():
+        _deadline_local.deadline = deadline
+        try:
+            outcome['result'] = func(*args, **kwargs)
+        except Exception as e:
+            outcome['error'] = e
+        finally:
+            done.set()
+
+    threading.Thread(target=target, daemon=True).start()
+    while not done.wait(CANCEL_POLL_INTERVAL_SECONDS):
+        deadline.check()
+    if 'error' in outcome:
+        raise outcome['error']
+    return outcome['result']
+
+class AdaptiveConcurrencyLimiter:
+    """LLM呼び出しの同時実行数を、応答時間とエラーから自動調整する（AIMD）
+
+    開始時は1から成功のたびに増やしてバックエンドが捌ける並列数を探り（スロースタート）、
+    エラーや応答時間の悪化を検知したら半減し、以降は少しずつ増やす。
+    応答時間の悪化は、呼び出しの種類（OCR・テキスト抽出・まとめての抽出）ごとに、
+    直近の指数移動平均が基準の LATENCY_TOLERANCE 倍を超えたかで判定する。
+    基準は他のLLM呼び出しが実行中でない時に開始したリクエスト（単独リクエスト）の応答時間の平均で、
+    1件ずつしか処理できないバックエンドでの順番待ちのように、こちらの並列化で生じる遅れは含まない。
+    スロースタートは、基準となる単独リクエストが LATENCY_WARMUP_SAMPLES 件集まるまで1のまま待つ。
+    """
+
+    def __init__(self, max_limit, logger):
+        self.max_limit = max_limit
+        self.limit = 1.0
+        self.peak_limit = 1.0
+        self.slow_start = True
+        self.in_flight = 0
+        self.latencies = {}
+        self.successes = 0
+        self.failures = 0
+        self.logger = logger
+        self._last_decrease_at = 0.0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        """同時実行枠を確保し、release に渡す (開始時刻, 単独リクエストか) を返す"""
+        deadline = current_deadline()
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                if deadline:
+                    deadline.check()
+                self._cond.wait(CANCEL_POLL_INTERVAL_SECONDS)
+            solo = self.in_flight == 0
+            self.in_flight += 1
+        return time.monotonic(), solo
+
+    def _baseline_ready(self, kind):
+        stats = self.latencies.get(kind)
+        return stats is not None and stats['samples'] >= LATENCY_WARMUP_SAMPLES
+
+    def _latency_congested(self, kind, latency, solo):
+        """応答時間を記録し、直近の応答時間が基準より大きく悪化しているかを返す"""
+        stats = self.latencies.setdefault(kind, {'short': None, 'baseline': None, 'samples': 0})
+        if stats['short'] is None:
+            stats['short'] = latency
+        else:
+            stats['short'] += LATENCY_SHORT_ALPHA * (latency - stats['short'])
+        # 単独リクエストは順番待ちを含まないため、遅ければバックエンド自体が遅くなったものとして基準に取り込む
+        # （基準ができるまでは単純平均とし、1件目の応答時間のばらつきに引きずられないようにする）
+        if solo:
+            stats['samples'] += 1
+            if stats['baseline'] is None:
+                stats['baseline'] = latency
+            else:
+                alpha = max(LATENCY_LONG_ALPHA, 1 / stats['samples'])
+                stats['baseline'] += alpha * (latency - stats['baseline'])
+        return self._baseline_ready(kind) and stats['short'] > stats['baseline'] * LATENCY_TOLERANCE
+
+    def release(self, kind, ticket, ok, cancelled=False):
+        """ticket は acquire の戻り値。
+        cancelled は期限切れ・中断で呼び出し元が待つのをやめたリクエストで、
+        バックエンドの失敗や混雑ではないため同時実行数の調整には使わない"""
+        started_at, solo = ticket
+        latency = time.monotonic() - started_at
+        with self._cond:
+            self.in_flight -= 1
+            if cancelled:
+                self._cond.notify_all()
+                return
+            if ok:
+                self.successes += 1
+                congested = self._latency_congested(kind, latency, solo)
+            else:
+                self.failures += 1
+                congested = True
+
+            if congested:
+                # 同じ混雑で何度も半減しないよう、前回の削減後に開始したリクエストのみ反映する
+                if started_at >= self._last_decrease_at:
+                    self.limit = max(1.0, self.limit / 2)
+                    self.slow_start = False
+                    self._last_decrease_at = time.monotonic()
+                    # 削減前の混雑した応答時間で再び判定しないよう、直近の平均は測り直す
+                    for stats in self.latencies.values():
+                        stats['short'] = None
+                    self.logger.debug(f"LLM同時実行数を削減しました: {self.limit:.1f} (応答時間 {latency:.1f}秒)")
+            elif self.slow_start:
+                if self._baseline_ready(kind):
+                    self.limit = min(float(self.max_limit), self.limit + 1)
+            else:
+                self.limit = min(float(self.max_limit), self.limit + 1 / self.limit)
+            self.peak_limit = max(self.peak_limit, self.limit)
+            self._cond.notify_all()
+
+    def call(self, kind, func, *args, **kwargs):
+        ticket = self.acquire()
+        ok = False
+        try:
+            result = func(*args, **kwargs)
+            ok = True
+            return result
+        finally:
+            # 期限切れで見捨てられたリクエストが（残り時間に合わせた）タイムアウトで失敗しても失敗として数えない
+            deadline = current_deadline()
+            self.release(kind, ticket, ok, cancelled=not ok and deadline is not None and deadline.expired())
+
+    def summary(self):
+        with self._cond:
+            return (f"LLM同時実行数（自動調整）: 最終 {int(self.limit)} / 最大 {int(self.peak_limit)} "
+                    f"(上限 {self.max_limit}、成功 {self.successes}件、失敗 {self.failures}件)")
+
+def call_with_llm_limit(kind, func, *args, **kwargs):
+    """LLM呼び出しを同時実行数の制限下で行う"""
+    if LLM_LIMITER is None:
+        return func(*args, **kwargs)
+    return LLM_LIMITER.call(kind, func, *args, **kwargs)
+
+def call_openwebui_chat(messages, logger, max_tokens=None):
     payload = {
         "model": LLM_MODEL,
         "temperature": LLM_TEMPERATURE,
-        "max_tokens": LLM_MAX_TOKENS,
+        "max_tokens": max_tokens or LLM_MAX_TOKENS,
         "messages": messages
     }
     data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
@@ -192,7 +557,7 @@ def call_openwebui_chat(messages, logger):
         method="POST",
     )
     try:
-        with request.urlopen(req, timeout=LLM_TIMEOUT_SECONDS) as resp:
+        with request.urlopen(req, timeout=llm_timeout()) as resp:
             body = resp.read().decode('utf-8')
     except error.HTTPError as e:
         error_body = e.read().decode('utf-8', errors='replace')
@@ -204,6 +569,8 @@ def call_openwebui_chat(messages, logger):
 
     try:
         parsed = json.loads(body)
+        if parsed["choices"][0].get("finish_reason") == "length":
+            logger.warning(f"LLMの応答が最大トークン数（{payload['max_tokens']}）で打ち切られました")
         content = parsed["choices"][0]["message"]["content"]
         if isinstance(content, list):
             joined = []
@@ -216,95 +583,410 @@ def call_openwebui_chat(messages, logger):
         logger.error(f"Open WebUI レスポンス解析に失敗しました: {e}, body={body}")
         raise RuntimeError("Open WebUI レスポンス解析に失敗しました")
 
+def get_gemini_model(instruction=None):
+    """Geminiのモデルオブジェクトを静的な指示ごとに使い回す（常駐モードで接続を維持するため）
+
+    静的な指示は system_instruction として常に同じ文字列で送り、プロバイダ側の
+    プレフィックスキャッシュが効くようにする。
+    """
+    with _gemini_model_lock:
+        model = _gemini_models.get(instruction)
+        if model is None:
+            if instruction:
+                model = genai.GenerativeModel(GEMINI_MODEL, system_instruction=instruction)
+            else:
+                model = genai.GenerativeModel(GEMINI_MODEL)
+            _gemini_models[instruction] = model
+        return model
+
+def gemini_request_options():
+    """期限付きで処理している場合のみタイムアウトを指定する"""
+    deadline = current_deadline()
+    if deadline is None or deadline.remaining() is None:
+        return {}
+    return {"request_options": {"timeout": llm_timeout()}}
+
+def warn_if_gemini_truncated(response, logger):
+    try:
+        finish_reason = response.candidates[0].finish_reason
+    except Exception:
+        return
+    if getattr(finish_reason, 'name', str(finish_reason)) == 'MAX_TOKENS':
+        logger.warning("LLMの応答が最大トークン数で打ち切られました")
+
 def llm_extract_text_from_image(base64_image, prompt, logger):
+    return run_cancellable(call_with_llm_limit, 'image', _llm_extract_text_from_image, base64_image, prompt, logger)
+
+def _llm_extract_text_from_image(base64_image, prompt, logger):
+    instruction, content = prompt
     if LLM_PROVIDER == "gemini":
-        model = genai.GenerativeModel("gemini-1.5-flash")
+        model = get_gemini_model(instruction)
         response = model.generate_content([
             {"mime_type": "image/jpeg", "data": base64_image},
-            prompt
-        ])
+            content
+        ], **gemini_request_options())
+        warn_if_gemini_truncated(response, logger)
         return response.text
 
     messages = [
+        {"role": "system", "content": instruction},
         {
             "role": "user",
             "content": [
-                {"type": "text", "text": prompt},
+                {"type": "text", "text": content},
                 {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}}
             ]
         }
     ]
-    return call_openwebui_chat(messages, logger)
+    return call_openwebui_chat(messages, logger, LLM_OCR_MAX_TOKENS)
+
+def llm_extract_structured_text(prompt, logger, max_tokens=None, kind='text'):
+    return run_cancellable(call_with_llm_limit, kind, _llm_extract_structured_text, prompt, logger, max_tokens)
 
-def llm_extract_structured_text(prompt, logger):
+def _llm_extract_structured_text(prompt, logger, max_tokens=None):
+    instruction, content = prompt
     if LLM_PROVIDER == "gemini":
-        model = genai.GenerativeModel("gemini-1.5-flash")
-        response = model.generate_content(prompt)
+        model = get_gemini_model(instruction)
+        response = model.generate_content(content, **gemini_request_options())
+        warn_if_gemini_truncated(response, logger)
         return response.text
 
-    messages = [{"role": "user", "content": prompt}]
-    return call_openwebui_chat(messages, logger)
-
-def generate_question(text, years=None):
-    year_instruction = f"""
-    提供するのは領収書の画像データです。OCRの結果から、会社名、支払日、支払い金額、摘要名を抽出するための質問です。
-    以下の質問に対して、日本語で回答してください。
-
-    ※重要な指示：
-    1. 支払日が不明な場合は {years[0] if years else ''} 年として処理してください。
-    2. 支払日の年が {years} のいずれでもない場合は、その旨を明確に示してください。
-    3. 年が不明確な場合（例：月日のみ）は {years[0] if years else ''} 年として処理してください。
-    4. 和暦の年号は以下のように西暦に変換してください：
-       - 令和元年 = 2019年
-       - 令和2年 = 2020年
-       - 令和3年 = 2021年
-       - 令和4年 = 2022年
-       - 令和5年 = 2023年
-       - 令和6年 = 2024年
-       - 令和7年 = 2025年
-       ※ "R06" "R6" "令6"なども令和6年として認識してください。
-       ※ 登録番号などに含まれる"R06"も令和6年を表す可能性があります。
-       ※ 和暦は令和しかありません。そのため、数字一桁なら令和の年号です。
-    5. 日付の優先順位：
-       1) 宿泊サービスの場合は宿泊最終日を支払日とする
-       2) 支払済印の日付
-       3) 領収印の日付
-       4) 取引日/利用日
-       5) 発行日
-       6) 登録番号内の日付（例：T9810999176881 R07 01 15）
-       ※ 支払期限や請求日は使用しないでください。
-       ※ 将来の日付は支払日として使用しないでください。
-       ※ 登録番号内の日付は「RXX XX XX」の形式で含まれることがあり、これは令和XX年XX月XX日を表します。
-    6. 電気料金の特別ルール：
-       1) 支払い先は「北陸電力」としてください
-       2) 支払日は「OCRテキスト（TXTファイル）の内容を必ず参照し、利用月やご使用期間から"利用月の20日〜23日の最初の営業日"を推定してください」
-       3) 例：2024年1月分の利用料金の場合、支払日は「2024-01-23」としてください
-       4) ファイル名例：2024-01-23_14930円_北陸電力.jpg
-    """ if years else ""
-
-    return  f"""
-    以下の領収書の内容から、会社名、支払日、支払い金額、摘要名を抽出してください。
-    {year_instruction}
-    支払い先の抽出ルール:
-    1. 店舗名がある場合は、メインの店舗名のみを抽出（例：「ジュンク堂書店」）
-    2. 支払い先と店舗名の両方がある場合は支払い先を優先（例：「楽天トラベル」）
-    3. 括弧内の英語表記や店舗場所は除外
-    4. チェーン店の場合は、チェーン名のみを使用（例：「ENEOS」）
-    5. 電気料金の場合は「北陸電力」としてください
-
-    {text}
-
-    結果は以下のフォーマットで返してください（シンプルに）:
-    会社名: [シンプルな会社名]
-    支払日: [支払日（西暦で）]
-    支払い金額: [支払い金額]
-    摘要名: [摘要名]
+    messages = [
+        {"role": "system", "content": instruction},
+        {"role": "user", "content": content},
+    ]
+    return call_openwebui_chat(messages, logger, max_tokens)
+
+def estimate_tokens(text):
+    """トークン数のおおよその見積もり（ASCIIは4文字で1トークン、それ以外は1文字1トークン）"""
+    ascii_chars = sum(1 for c in text if ord(c) < 128)
+    return ascii_chars // 4 + (len(text) - ascii_chars)
+
+def truncate_to_tokens(text, max_tokens):
+    """推定トークン数が上限に収まるよう先頭から切り詰める"""
+    cost = 0.0
+    for i, c in enumerate(text):
+        cost += 0.25 if ord(c) < 128 else 1
+        if cost > max_tokens:
+            return text[:i]
+    return text
+
+def fit_text_to_budget(text, max_tokens, logger=None):
+    """OCRテキストがトークン予算を超える場合に切り詰める
+
+    各ページの「支払い情報」欄は必ず残し、残りの予算で先頭から本文を残す。
+    """
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    summaries = [match.group(0).strip() for page in text.split(PAGE_SEPARATOR)
+                 for match in [re.search(r'---支払い情報---.*?(?=\n---|\Z)', page, re.DOTALL)] if match]
+    kept = "\n\n".join(summaries)
+    head = truncate_to_tokens(text, max(max_tokens - estimate_tokens(kept) - 20, 0))
+    trimmed = truncate_to_tokens(f"{head}\n\n...（省略）...\n\n{kept}".strip(), max_tokens)
+    if logger:
+        logger.warning(f"OCRテキストがトークン予算を超えたため切り詰めました: 推定 {estimate_tokens(text)} -> {estimate_tokens(trimmed)} トークン")
+    return trimmed
+
+class PromptTemplate:
+    """静的な指示（先頭に置く共通部分）と、ファイルごとに変わる部分に分けたプロンプト
+
+    指示は起動時に一度だけ組み立て、プロバイダ側のプレフィックスキャッシュが効くよう常に同じ文字列で送る。
     """
 
+    def __init__(self, instruction, content_template):
+        self.instruction = instruction.strip()
+        self.content_template = content_template.strip()
+        self.instruction_tokens = estimate_tokens(self.instruction)
+
+    def render(self, **values):
+        return self.instruction, self.content_template.format(**values)
+
+    def overhead_tokens(self, **values):
+        """本文（text）以外の部分の推定トークン数"""
+        instruction, content = self.render(**values)
+        return estimate_tokens(instruction) + estimate_tokens(content)
+
+def generate_question(text, years=None, logger=None):
+    """1件の領収書から情報を抽出する質問を (静的な指示, 可変部分) で返す"""
+    if years:
+        template = EXTRACTION_PROMPT_WITH_YEARS
+        values = {'default_year': years[0], 'years': years}
+    else:
+        template = EXTRACTION_PROMPT
+        values = {}
+    if LLM_CONTEXT_TOKENS is not None:
+        budget = LLM_CONTEXT_TOKENS - template.overhead_tokens(text='', **values) - LLM_MAX_TOKENS
+        text = fit_text_to_budget(text, budget, logger)
+    return template.render(text=text, **values)
+
+def generate_batch_question(items, years=None):
+    """複数の領収書をまとめて抽出する質問（共通の指示は1回だけ記載）"""
+    receipts = "\n\n".join(f"### {key}\n{text}" for key, text in items)
+    if years:
+        return BATCH_EXTRACTION_PROMPT_WITH_YEARS.render(receipts=receipts, default_year=years[0], years=years)
+    return BATCH_EXTRACTION_PROMPT.render(receipts=receipts)
+
+# プロンプトテンプレート（起動時に一度だけ組み立てる）
+PAGE_SEPARATOR = "\n\n=== ページの区切り ===\n\n"
+
+REIWA_RULES = """
+和暦の年号は以下のように西暦に変換してください：
+- 令和元年 = 2019年
+- 令和2年 = 2020年
+- 令和3年 = 2021年
+- 令和4年 = 2022年
+- 令和5年 = 2023年
+- 令和6年 = 2024年
+- 令和7年 = 2025年
+※ "R06" "R6" "令6"なども令和6年として認識してください。
+※ 登録番号などに含まれる"R06"も令和6年を表す可能性があります。
+※ 和暦は令和しかありません。そのため、数字一桁なら令和の年号です。
+""".strip()
+
+DATE_RULES = """
+提供するのは領収書の画像データです。OCRの結果から、会社名、支払日、支払い金額、摘要名を抽出するための質問です。
+以下の質問に対して、日本語で回答してください。
+
+※重要な指示：
+1. 和暦の変換：
+""" + REIWA_RULES + """
+2. 日付の優先順位：
+   1) 宿泊サービスの場合は宿泊最終日を支払日とする
+   2) 支払済印の日付
+   3) 領収印の日付
+   4) 取引日/利用日
+   5) 発行日
+   6) 登録番号内の日付（例：T9810999176881 R07 01 15）
+   ※ 支払期限や請求日は使用しないでください。
+   ※ 将来の日付は支払日として使用しないでください。
+   ※ 登録番号内の日付は「RXX XX XX」の形式で含まれることがあり、これは令和XX年XX月XX日を表します。
+3. 電気料金の特別ルール：
+   1) 支払い先は「北陸電力」としてください
+   2) 支払日は「OCRテキスト（TXTファイル）の内容を必ず参照し、利用月やご使用期間から"利用月の20日〜23日の最初の営業日"を推定してください」
+   3) 例：2024年1月分の利用料金の場合、支払日は「2024-01-23」としてください
+   4) ファイル名例：2024-01-23_14930円_北陸電力.jpg
+4. 年の扱いは末尾の「年の指定」に従ってください。
+""".strip()
+
+PAYEE_RULES = """
+支払い先の抽出ルール:
+1. 店舗名がある場合は、メインの店舗名のみを抽出（例：「ジュンク堂書店」）
+2. 支払い先と店舗名の両方がある場合は支払い先を優先（例：「楽天トラベル」）
+3. 括弧内の英語表記や店舗場所は除外
+4. チェーン店の場合は、チェーン名のみを使用（例：「ENEOS」）
+5. 電気料金の場合は「北陸電力」としてください
+""".strip()
+
+# 年の指定は実行ごとに変わるため、静的な指示の後ろに置く（波括弧は format で埋める）
+YEAR_RULES_TEMPLATE = """
+※年の指定：
+1. 支払日が不明な場合は {default_year} 年として処理してください。
+2. 支払日の年が {years} のいずれでもない場合は、その旨を明確に示してください。
+3. 年が不明確な場合（例：月日のみ）は {default_year} 年として処理してください。
+""".strip()
+
+RESULT_FORMAT = """
+結果は以下のフォーマットで返してください（シンプルに）:
+会社名: [シンプルな会社名]
+支払日: [支払日（西暦で）]
+支払い金額: [支払い金額]
+摘要名: [摘要名]
+""".strip()
+
+BATCH_RESULT_FORMAT = """
+結果は以下のようなJSONのみで返してください（説明文やコードブロックは不要）:
+{"ID": {"会社名": "シンプルな会社名", "支払日": "支払日（西暦で）", "支払い金額": "支払い金額", "摘要名": "摘要名"}}
+""".strip()
+
+OCR_PROMPT = PromptTemplate(
+    "この領収書の内容を読み取ってください。\n以下の形式で回答してください：\n\n※重要な指示：\n" + REIWA_RULES + """
+
+---OCRデータ---
+[読み取ったテキストをそのまま出力してください]
+
+---支払い情報---
+支払日：[支払日を記載（和暦は上記の通り西暦に変換）]
+支払先：[支払先の正式名称]
+支払金額：[支払金額を数字のみで記載]
+摘要：[支払内容や品目名]
+
+---その他の情報---
+[その他の重要な情報を箇条書きで記述]
+""",
+    "@入力ファイル名\n{filename}\n@ページ番号: {page}/{total}",
+)
+
+_EXTRACTION_HEADER = "以下の領収書の内容から、会社名、支払日、支払い金額、摘要名を抽出してください。"
+_BATCH_EXTRACTION_HEADER = ("以下の複数の領収書の内容から、それぞれ会社名、支払日、支払い金額、摘要名を抽出してください。\n"
+                            "各領収書は「### ID」の見出しで区切られています。")
+
+EXTRACTION_PROMPT = PromptTemplate(
+    "\n\n".join([_EXTRACTION_HEADER, PAYEE_RULES, RESULT_FORMAT]),
+    "---領収書の内容---\n{text}",
+)
+EXTRACTION_PROMPT_WITH_YEARS = PromptTemplate(
+    "\n\n".join([_EXTRACTION_HEADER, DATE_RULES, PAYEE_RULES, RESULT_FORMAT]),
+    YEAR_RULES_TEMPLATE + "\n\n---領収書の内容---\n{text}",
+)
+BATCH_EXTRACTION_PROMPT = PromptTemplate(
+    "\n\n".join([_BATCH_EXTRACTION_HEADER, PAYEE_RULES, BATCH_RESULT_FORMAT]),
+    "{receipts}",
+)
+BATCH_EXTRACTION_PROMPT_WITH_YEARS = PromptTemplate(
+    "\n\n".join([_BATCH_EXTRACTION_HEADER, DATE_RULES, PAYEE_RULES, BATCH_RESULT_FORMAT]),
+    YEAR_RULES_TEMPLATE + "\n\n{receipts}",
+)
+
+# テンプレートの内容から決まるバージョン（抽出結果の再利用可否の判定に使う）
+PROMPT_VERSION = hashlib.sha256("\0".join(
+    part
+    for template in (OCR_PROMPT, EXTRACTION_PROMPT, EXTRACTION_PROMPT_WITH_YEARS,
+                     BATCH_EXTRACTION_PROMPT, BATCH_EXTRACTION_PROMPT_WITH_YEARS)
+    for part in (template.instruction, template.content_template)
+).encode('utf-8')).hexdigest()[:12]
+
+
+def parse_batch_result(result):
+    """まとめて抽出した結果（JSON）を、ID ごとの通常の回答形式に変換する"""
+    match = re.search(r'\{.*\}', result, re.DOTALL)
+    if not match:
+        raise ValueError("JSONが見つかりません")
+    parsed = json.loads(match.group(0))
+    answers = {}
+    for key, fields in parsed.items():
+        if not isinstance(fields, dict):
+            continue
+        answers[str(key)] = "\n".join(
+            f"{name}: {fields.get(name, '')}" for name in ('会社名', '支払日', '支払い金額', '摘要名')
+        )
+    return answers
+
+class StructuredExtractionBatcher:
+    """複数のワーカーから渡されたOCRテキストをまとめて1回のリクエストで抽出する
+
+    推定トークン数が上限に達するか、最初のテキストを受け取ってから一定時間が経過すると送信する。
+    上限を超える大きなテキストは単独で通常の質問として送信する。
+    """
+
+    def __init__(self, years, logger, max_tokens=DEFAULT_BATCH_MAX_TOKENS):
+        self.years = years
+        self.logger = logger
+        # 応答分を差し引いたコンテキスト長を超えないようにする
+        self.max_tokens = max_tokens
+        if LLM_CONTEXT_TOKENS is not None:
+            self.max_tokens = min(max_tokens, LLM_CONTEXT_TOKENS - LLM_MAX_TOKENS
+                                  - BATCH_RESPONSE_TOKENS_PER_FILE * BATCH_MAX_FILES)
+        self.base_tokens = sum(estimate_tokens(part) for part in generate_batch_question([], years))
+        self._cond = threading.Condition()
+        self._pending = []
+        self._pending_tokens = 0
+        self._first_at = None
+        self._counter = 0
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def extract(self, filename, text):
+        """テキストを登録し、抽出結果（通常の回答形式）が得られるまで待つ"""
+        tokens = estimate_tokens(text)
+        if self.base_tokens + tokens > self.max_tokens:
+            return llm_extract_structured_text(generate_question(text, self.years, self.logger), self.logger)
+
+        item = {'text': text, 'tokens': tokens, 'filename': filename,
+                'done': threading.Event(), 'result': None, 'error': None}
+        with self._cond:
+            self._counter += 1
+            item['key'] = f"R{self._counter}"
+            if self._pending_tokens + tokens + self.base_tokens > self.max_tokens:
+                self._cond.notify_all()
+                while self._pending and self._pending_tokens + tokens + self.base_tokens > self.max_tokens:
+                    self._cond.wait()
+            if not self._pending:
+                self._first_at = time.monotonic()
+            self._pending.append(item)
+            self._pending_tokens += tokens
+            self._cond.notify_all()
+        deadline = current_deadline()
+        while not item['done'].wait(CANCEL_POLL_INTERVAL_SECONDS):
+            if deadline:
+                deadline.check()
+        if item['error']:
+            raise item['error']
+        return item['result']
+
+    def _take_batch(self):
+        with self._cond:
+            while True:
+                if self._pending:
+                    full = (len(self._pending) >= BATCH_MAX_FILES
+                            or self._pending_tokens + self.base_tokens >= self.max_tokens * 0.8)
+                    remaining = BATCH_LINGER_SECONDS - (time.monotonic() - self._first_at)
+                    if full or remaining <= 0 or self._closed:
+                        batch = self._pending[:BATCH_MAX_FILES]
+                        self._pending = self._pending[BATCH_MAX_FILES:]
+                        self._pending_tokens = sum(item['tokens'] for item in self._pending)
+                        self._first_at = time.monotonic() if self._pending else None
+                        self._cond.notify_all()
+                        return batch
+                    self._cond.wait(remaining)
+                elif self._closed:
+                    return None
+                else:
+                    self._cond.wait()
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            if batch is None:
+                return
+            threading.Thread(target=self._send, args=(batch,), daemon=True).start()
+
+    def _send(self, batch):
+        answers = {}
+        if len(batch) > 1:
+            try:
+                result = llm_extract_structured_text(
+                    generate_batch_question([(item['key'], item['text']) for item in batch], self.years),
+                    self.logger,
+                    max_tokens=BATCH_RESPONSE_TOKENS_PER_FILE * len(batch) + LLM_MAX_TOKENS,
+                    # まとめての抽出は1件の抽出より大幅に時間がかかるため、応答時間の基準を分ける
+                    kind='text_batch',
+                )
+                answers = parse_batch_result(result)
+                self.logger.info(f"{len(batch)}件の領収書をまとめて抽出しました")
+            except Exception as e:
+                self.logger.warning(f"まとめての抽出に失敗したため個別に抽出します: {e}")
+
+        for item in batch:
+            item['result'] = answers.get(item['key'])
+            if item['result'] is None:
+                # 結果に含まれなかった領収書は個別に抽出する
+                # 待っているファイルが順番待ちにならないよう並行して送る（同時実行数は LLM_LIMITER が制御する）
+                threading.Thread(target=self._send_single, args=(item,), daemon=True).start()
+            else:
+                item['done'].set()
+
+    def _send_single(self, item):
+        try:
+            item['result'] = llm_extract_structured_text(
+                generate_question(item['text'], self.years, self.logger), self.logger)
+        except Exception as e:
+            item['error'] = e
+        finally:
+            item['done'].set()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+
 def pdf_to_jpeg(pdf_path, temp_dir, logger):
     """PDFの全ページをJPEGに変換"""
     try:
-        images = convert_from_path(pdf_path)
+        deadline = current_deadline()
+        remaining = deadline.remaining() if deadline else None
+        images = convert_from_path(pdf_path, timeout=max(remaining, 1) if remaining is not None else None)
         jpeg_paths = []
         for i, image in enumerate(images):
             jpeg_path = os.path.join(temp_dir, f"page_{i+1}.jpg")
@@ -353,28 +1035,689 @@ def backup_file(file_path, backup_dir, logger):
         logger.error(f"ファイルのバックアップに失敗しました: {e}")
         return False, None
 
+def rollback_file_operations(moved_files, created_files, logger):
+    """途中で失敗したリネーム処理を取り消し、元のファイルを元の場所に戻す"""
+    for created_path in reversed(created_files):
+        try:
+            if os.path.exists(created_path):
+                os.remove(created_path)
+        except Exception as e:
+            logger.error(f"作成したファイルの削除に失敗しました: {created_path}: {e}")
+    for original_path, backup_path in reversed(moved_files):
+        try:
+            shutil.move(backup_path, original_path)
+            logger.info(f"ファイルを元の場所に戻しました: {original_path}")
+        except Exception as e:
+            logger.error(f"ファイルを元の場所に戻せませんでした: {backup_path} -> {original_path}: {e}")
+
+@functools.lru_cache(maxsize=PDF_INFO_CACHE_SIZE)
+def _read_pdf_info(pdf_path, size, mtime):
+    """(パス, サイズ, 更新時刻) ごとにキャッシュする（スキャナが同じファイル名を再利用しても古い情報を返さない）"""
+    return pdfinfo_from_path(pdf_path)
+
+def get_pdf_page_info(pdf_path, logger):
+    """PDFをラスタライズせずにページ数とページサイズ（pt）を取得"""
+    try:
+        stat = os.stat(pdf_path)
+        info = _read_pdf_info(os.path.abspath(pdf_path), stat.st_size, stat.st_mtime)
+    except Exception as e:
+        logger.debug(f"PDF情報の取得に失敗しました: {pdf_path}: {e}")
+        return 1, None
+    pages = int(info.get('Pages', 1) or 1)
+    size_match = re.match(r'([\d.]+)\s*x\s*([\d.]+)', str(info.get('Page size', '')))
+    page_size = (float(size_match.group(1)), float(size_match.group(2))) if size_match else None
+    return pages, page_size
+
+def estimate_file_memory(file_path, logger):
+    """処理中に保持されるおおよそのメモリ量（バイト）を見積もる
+
+    画像の生データ、Base64文字列、JSONペイロードの3つのコピーに加え、
+    PDFの場合は全ページ分のPIL画像を保持する点を考慮する。
+    """
+    if is_text_cached(file_path):
+        return 0
+    try:
+        file_size = os.path.getsize(file_path)
+    except OSError:
+        return 0
+
+    # 生バイト + Base64（4/3倍） + JSONエンコード後のペイロード（4/3倍）
+    payload_factor = 1 + 4 / 3 + 4 / 3
+    if not file_path.lower().endswith('.pdf'):
+        return int(file_size * payload_factor)
+
+    pages, page_size = get_pdf_page_info(file_path, logger)
+    width_pt, height_pt = page_size or (595.0, 842.0)  # 不明な場合はA4として扱う
+    raster_bytes = int(width_pt / 72 * PDF_RENDER_DPI) * int(height_pt / 72 * PDF_RENDER_DPI) * 3
+    jpeg_bytes = raster_bytes // JPEG_COMPRESSION_RATIO
+    return file_size + pages * (raster_bytes + int(jpeg_bytes * payload_factor))
+
+def is_text_cached(file_path):
+    """OCR済みのテキストファイルが既にあるか（画像のOCRを省略できるか）"""
+    return os.path.exists(f"{os.path.splitext(file_path)[0]}.txt")
+
+def get_image_pixels(image_path, logger):
+    """画像をデコードせずにヘッダから画素数を取得"""
+    try:
+        with Image.open(image_path) as image:
+            width, height = image.size
+        return width * height
+    except Exception as e:
+        logger.debug(f"画像サイズの取得に失敗しました: {image_path}: {e}")
+        return REFERENCE_PAGE_PIXELS
+
+def estimate_file_cost(file_path, logger):
+    """ファイルの処理時間の相対的な見積もり（OCR 1ページ分を 1.0 とする）"""
+    if is_text_cached(file_path):
+        return STRUCTURED_STAGE_COST
+
+    if file_path.lower().endswith('.pdf'):
+        pages, page_size = get_pdf_page_info(file_path, logger)
+        width_pt, height_pt = page_size or (595.0, 842.0)
+        pixels = (width_pt / 72 * PDF_RENDER_DPI) * (height_pt / 72 * PDF_RENDER_DPI)
+    else:
+        pages, pixels = 1, get_image_pixels(file_path, logger)
+
+    # 画素数が多いほどアップロードと推論に時間がかかるため緩やかに重み付けする
+    page_cost = 0.5 + 0.5 * min(pixels / REFERENCE_PAGE_PIXELS, 4.0)
+    return pages * page_cost + STRUCTURED_STAGE_COST
+
+def schedule_files(file_paths, logger):
+    """処理順序を決める
+
+    OCR済み（テキストキャッシュあり）のファイルは高速レーン用に分離し、
+    残りは見積もりコストの大きい順（LPT）に並べる。
+    """
+    cached_files = [f for f in file_paths if is_text_cached(f)]
+    cached_set = set(cached_files)
+    costs = {f: estimate_file_cost(f, logger) for f in file_paths if f not in cached_set}
+    heavy_files = sorted(costs, key=costs.get, reverse=True)
+    for f in heavy_files:
+        logger.debug(f"処理コスト見積もり: {os.path.basename(f)} = {costs[f]:.2f}")
+    return cached_files, heavy_files
+
+def read_cgroup_memory_limit():
+    """コンテナ（cgroup）のメモリ上限を取得する（制限なし・取得できない場合は None）"""
+    for path in CGROUP_MEMORY_LIMIT_FILES:
+        try:
+            with open(path, 'r') as f:
+                value = f.read().strip()
+        except OSError:
+            continue
+        if not value.isdigit():
+            continue  # cgroup v2 の "max" は制限なし
+        limit = int(value)
+        # cgroup v1 で制限がない場合は極端に大きな値が入っている
+        if limit >= CGROUP_UNLIMITED_THRESHOLD:
+            continue
+        return limit
+    return None
+
+def default_memory_budget():
+    """利用可能なメモリの半分を既定のメモリ予算とする（取得できない場合は固定値）
+
+    コンテナ内では物理メモリではなく cgroup の上限が実際の上限になるため、
+    両方が取得できる場合は小さい方を使う。
+    """
+    limits = []
+    try:
+        limits.append(os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES'))
+    except (AttributeError, ValueError, OSError):
+        pass
+    cgroup_limit = read_cgroup_memory_limit()
+    if cgroup_limit:
+        limits.append(cgroup_limit)
+    if not limits:
+        return DEFAULT_MEMORY_BUDGET_MB * 1024 * 1024
+    return min(limits) // 2
+
+class MemoryBudget:
+    """推定メモリ使用量の合計が予算内に収まる間だけ処理を許可する
+
+    予算を超える大きなファイルは、他に処理中のファイルがなくなってから単独で実行する。
+    """
+
+    def __init__(self, budget_bytes):
+        self.budget_bytes = budget_bytes
+        self.in_flight = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, cost):
+        """予算を確保する。待機中に期限切れや中断要求があれば ProcessingCancelled を送出する"""
+        deadline = current_deadline() or _run_deadline
+        with self._cond:
+            while self.in_flight > 0 and self.in_flight + cost > self.budget_bytes:
+                if deadline:
+                    deadline.check()
+                self._cond.wait(CANCEL_POLL_INTERVAL_SECONDS)
+            self.in_flight += cost
+
+    def release(self, cost):
+        with self._cond:
+            self.in_flight -= cost
+            self._cond.notify_all()
+
+def process_file_with_budget(file_path, args, logger, backup_dir, memory_budget, similarity_index=None,
+                             batcher=None):
+    """メモリ予算を確保してからファイルを処理"""
+    cost = estimate_file_memory(file_path, logger)
+    if cost > memory_budget.budget_bytes:
+        logger.info(f"メモリ予算を超えるため単独で処理します: {os.path.basename(file_path)} "
+                    f"(推定 {cost / 1024 / 1024:.0f}MB)")
+    try:
+        memory_budget.acquire(cost)
+    except ProcessingCancelled as e:
+        # 処理を始める前に中断されたファイルは元の場所に残っているため、次回の実行で処理される
+        message = f"中断：{os.path.basename(file_path)}（{e}）"
+        print(message)
+        logger.warning(message)
+        if not isinstance(e, LeaseLost):
+            (current_deadline() or _run_deadline).record_unfinished(file_path)
+        return None
+    try:
+        return process_file(file_path, args, logger, backup_dir, similarity_index, batcher)
+    finally:
+        memory_budget.release(cost)
+
+class LeaseStore:
+    """共有ディレクトリ上のSQLiteファイルでファイルごとの処理権（リース）を管理する
+
+    リースには有効期限があり、処理中は定期的に延長する。
+    停止したノードのリースは期限切れになり、他のノードが引き継ぐ。
+    処理に失敗したファイルは 'failed' として記録し（expires_at には失敗した時刻を入れる）、
+    失敗より前に開始したノードは、ファイルが変更されない限り同じ実行の中で再処理しない。
+    パスはDBファイルのあるディレクトリからの相対パスで記録するため、
+    ノードごとにマウント位置が異なっても同じファイルとして扱える。
+    """
+
+    def __init__(self, db_path, node_id, ttl_seconds, logger):
+        self.db_path = os.path.abspath(db_path)
+        self.root_dir = os.path.dirname(self.db_path)
+        self.node_id = node_id
+        self.ttl_seconds = ttl_seconds
+        self.logger = logger
+        self.started_at = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS leases (
+                    path TEXT PRIMARY KEY,
+                    owner TEXT NOT NULL,
+                    expires_at REAL NOT NULL,
+                    status TEXT NOT NULL,
+                    size INTEGER,
+                    mtime REAL
+                )
+            """)
+        finally:
+            conn.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+
+    def _key(self, file_path):
+        return os.path.relpath(os.path.abspath(file_path), self.root_dir)
+
+    def _execute(self, sql, params):
+        """1文を排他トランザクションで実行し、変更行数を返す"""
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            cursor = conn.execute(sql, params)
+            conn.execute("COMMIT")
+            return cursor.rowcount
+        finally:
+            conn.close()
+
+    def claim(self, file_path):
+        """リースを取得できた場合に True を返す"""
+        try:
+            stat = os.stat(file_path)
+        except FileNotFoundError:
+            # 他のノードが処理済みでバックアップに移動した
+            return False
+        key = self._key(file_path)
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT owner, expires_at, status, size, mtime FROM leases WHERE path = ?", (key,)
+            ).fetchone()
+            if row:
+                owner, expires_at, status, size, mtime = row
+                unchanged = (size, mtime) == (stat.st_size, stat.st_mtime)
+                if status == 'done' and unchanged:
+                    conn.execute("ROLLBACK")
+                    return False
+                if status == 'failed' and unchanged and expires_at >= self.started_at:
+                    self.logger.info(f"他のノードで処理に失敗したためスキップします: {key} (ノード: {owner})")
+                    conn.execute("ROLLBACK")
+                    return False
+                if status == 'active' and owner != self.node_id and expires_at > now:
+                    conn.execute("ROLLBACK")
+                    return False
+                if status == 'active' and owner != self.node_id:
+                    self.logger.warning(f"期限切れのリースを引き継ぎます: {key} (前の所有者: {owner})")
+            conn.execute(
+                "INSERT OR REPLACE INTO leases (path, owner, expires_at, status, size, mtime) "
+                "VALUES (?, ?, ?, 'active', ?, ?)",
+                (key, self.node_id, now + self.ttl_seconds, stat.st_size, stat.st_mtime)
+            )
+            conn.execute("COMMIT")
+            return True
+        finally:
+            conn.close()
+
+    def renew(self, file_path):
+        """リースを延長する。他のノードに奪われていた場合は False を返す"""
+        return self._execute(
+            "UPDATE leases SET expires_at = ? WHERE path = ? AND owner = ? AND status = 'active'",
+            (time.time() + self.ttl_seconds, self._key(file_path), self.node_id)
+        ) > 0
+
+    def complete(self, file_path):
+        """処理済みとして記録する"""
+        self._execute(
+            "UPDATE leases SET status = 'done' WHERE path = ? AND owner = ?",
+            (self._key(file_path), self.node_id)
+        )
+
+    def fail(self, file_path):
+        """処理に失敗したことを記録し、同じ実行中の他のノードが再処理しないようにする"""
+        self._execute(
+            "UPDATE leases SET status = 'failed', expires_at = ? WHERE path = ? AND owner = ? AND status = 'active'",
+            (time.time(), self._key(file_path), self.node_id)
+        )
+
+    def release(self, file_path):
+        """中断した場合にリースを解放し、他のノードや次回の実行で処理できるようにする"""
+        self._execute(
+            "DELETE FROM leases WHERE path = ? AND owner = ? AND status = 'active'",
+            (self._key(file_path), self.node_id)
+        )
+
+    def is_held_by_other(self, file_path):
+        """他のノードが有効なリースを保持しているか"""
+        conn = self._connect()
+        try:
+            row = conn.execute(
+                "SELECT owner, expires_at, status FROM leases WHERE path = ?", (self._key(file_path),)
+            ).fetchone()
+        finally:
+            conn.close()
+        return bool(row) and row[2] == 'active' and row[0] != self.node_id and row[1] > time.time()
+
+class LeaseRenewer:
+    """処理中のリースをバックグラウンドで定期的に延長する
+
+    リースを失った場合（他のノードに奪われた、または延長の失敗が続いて期限が過ぎた）は、
+    同じファイルを二重に処理しないよう deadline を中断して処理中のファイルを打ち切る。
+    """
+
+    def __init__(self, lease_store, file_path, deadline):
+        self.lease_store = lease_store
+        self.file_path = file_path
+        self.deadline = deadline
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        interval = max(self.lease_store.ttl_seconds / 3, 1)
+        renewed_at = time.time()
+        while not self._stop.wait(interval):
+            try:
+                if self.lease_store.renew(self.file_path):
+                    renewed_at = time.time()
+                    continue
+                reason = "他のノードに奪われました"
+            except sqlite3.Error as e:
+                self.lease_store.logger.warning(f"リースの延長に失敗しました: {e}")
+                if time.time() - renewed_at < self.lease_store.ttl_seconds:
+                    continue
+                reason = "延長できないまま期限が過ぎました"
+            self.lost = True
+            self.lease_store.logger.warning(
+                f"リースを失ったため処理を中断します: {os.path.basename(self.file_path)}（{reason}）")
+            self.deadline.cancel(LeaseLost(f"リースを失いました（{reason}）"))
+            return
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stop.set()
+        self._thread.join()
+        return False
+
+def process_file_with_lease(file_path, lease_store, logger, process, *process_args):
+    """リースを取得できた場合のみ処理する。(リースを取得したか, 処理結果) を返す"""
+    try:
+        if not lease_store.claim(file_path):
+            logger.debug(f"他のノードが処理中または処理済みのためスキップします: {file_path}")
+            return False, None
+    except sqlite3.Error as e:
+        logger.error(f"リースの取得に失敗しました: {file_path}: {e}")
+        return False, None
+
+    # 処理中のファイルの期限はこの期限を親とするため、リースを失えば処理が中断される
+    lease_deadline = Deadline(parent=current_deadline() or _run_deadline)
+    previous_deadline = current_deadline()
+    _deadline_local.deadline = lease_deadline
+    result = None
+    try:
+        with LeaseRenewer(lease_store, file_path, lease_deadline):
+            result = process(file_path, *process_args)
+    finally:
+        _deadline_local.deadline = previous_deadline
+        try:
+            if result:
+                lease_store.complete(file_path)
+            elif lease_deadline.expired():
+                # 実行全体の期限切れ・Ctrl-C・リースの喪失による中断は、他のノードが処理できるよう解放する
+                lease_store.release(file_path)
+            else:
+                lease_store.fail(file_path)
+        except sqlite3.Error as e:
+            logger.error(f"リースの更新に失敗しました: {file_path}: {e}")
+    return True, result
+
+def run_file_task(file_path, lease_store, logger, process, *process_args):
+    """分散処理モードではリースを取得してから処理する。(処理したか, 処理結果) を返す"""
+    if lease_store is None:
+        return True, process(file_path, *process_args)
+    return process_file_with_lease(file_path, lease_store, logger, process, *process_args)
+
+def wait_for_other_nodes(file_paths, lease_store, logger, process, *process_args):
+    """他のノードが処理中のファイルを見守り、リースが期限切れになったら引き継ぐ"""
+    pending = list(file_paths)
+    interval = max(lease_store.ttl_seconds / 3, 1)
+    while pending:
+        if _run_deadline is not None and _run_deadline.expired():
+            for file_path in pending:
+                _run_deadline.record_unfinished(file_path)
+            return
+        still_pending = []
+        for file_path in pending:
+            try:
+                if not os.path.exists(file_path):
+                    continue
+                if lease_store.is_held_by_other(file_path):
+                    still_pending.append(file_path)
+                    continue
+                process_file_with_lease(file_path, lease_store, logger, process, *process_args)
+            except sqlite3.Error as e:
+                logger.error(f"リースの確認に失敗しました: {file_path}: {e}")
+        pending = still_pending
+        if pending:
+            logger.info(f"他のノードが処理中のファイルを待機しています: {len(pending)}件")
+            time.sleep(interval)
+
+def append_receipt_log(log_file, new_path):
+    """receipt_log.csv に追記（複数ノードからの同時書き込みに備えてロックする）"""
+    with open(log_file, mode="a", newline="", encoding="utf-8") as f:
+        if fcntl:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            writer = csv.writer(f)
+            writer.writerow([new_path])
+            f.flush()
+        finally:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+def compute_image_hash(image_path):
+    """画像の差分ハッシュ（dHash, 64bit）を計算"""
+    with Image.open(image_path) as image:
+        image.draft('L', (64, 64))
+        small = image.convert('L').resize((9, 8), Image.LANCZOS)
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            right = pixels[row * 9 + col + 1]
+            value = (value << 1) | (1 if left > right else 0)
+    return value
+
+def compute_image_hashes(image_paths, logger):
+    """画像（PDFの場合は各ページ）のハッシュのリストを返す"""
+    try:
+        return [compute_image_hash(image_path) for image_path in image_paths]
+    except Exception as e:
+        logger.debug(f"画像ハッシュの計算に失敗しました: {e}")
+        return None
+
+def compute_text_signature(text):
+    """OCRテキストの文字シングルからMinHash署名を計算"""
+    normalized = re.sub(r'\s+', '', text or '')
+    shingles = {normalized[i:i + MINHASH_SHINGLE_SIZE]
+                for i in range(max(len(normalized) - MINHASH_SHINGLE_SIZE + 1, 0))}
+    if not shingles:
+        return None
+    hashes = [int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest(), 'big')
+              for shingle in shingles]
+    return [min((a * h + b) % _MERSENNE_PRIME for h in hashes) for a, b in MINHASH_PARAMS]
+
+def extract_payment_fields(text):
+    """OCRテキストの各ページの「支払い情報」欄から (支払日, 支払金額) を取り出す
+
+    日付は年月日の数字、金額は数字のみに正規化する。どちらかが読み取れない場合は None を返す。
+    """
+    if not text:
+        return None
+    fields = []
+    for page in text.split(PAGE_SEPARATOR):
+        match = re.search(r'---支払い情報---(.*?)(?=\n---|\Z)', page, re.DOTALL)
+        if not match:
+            continue
+        section = match.group(1)
+        date_match = re.search(r'支払日[:：]\s*(.+)', section)
+        amount_match = re.search(r'支払金額[:：]\s*(.+)', section)
+        if not date_match or not amount_match:
+            continue
+        date_numbers = re.findall(r'\d+', date_match.group(1))
+        amount = ''.join(filter(str.isdigit, amount_match.group(1)))
+        if len(date_numbers) < 3 or not amount:
+            continue
+        fields.append(('-'.join(str(int(n)) for n in date_numbers[:3]), str(int(amount))))
+    return tuple(fields) or None
+
+class SimilarityIndex:
+    """処理済み領収書の画像ハッシュとテキスト署名を保持し、類似ファイルを検索する"""
+
+    def __init__(self, index_path, logger):
+        self.index_path = index_path
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.entries = self._load()
+
+    def _load(self):
+        if not os.path.exists(self.index_path):
+            return []
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                return json.load(f).get('entries', [])
+        except Exception as e:
+            self.logger.warning(f"類似検索インデックスの読み込みに失敗しました: {e}")
+            return []
+
+    @staticmethod
+    def _entry_key(entry):
+        return entry.get('id') or json.dumps(entry, sort_keys=True, ensure_ascii=False)
+
+    def find_duplicate(self, image_hashes, signature, text):
+        """処理済みの領収書のうち、同じ領収書と判断できるエントリを返す
+
+        画像ハッシュ（ページのレイアウト）やOCRテキストの類似だけでは、同じ書式の毎月の請求書を
+        区別できないため、OCRの「支払い情報」欄の支払日・支払金額が一致することを必須とする。
+        """
+        payment = extract_payment_fields(text)
+        if not payment:
+            return None
+        best, best_score = None, 0
+        with self.lock:
+            for entry in self.entries:
+                if entry.get('prompt_version') != PROMPT_VERSION:
+                    continue
+                score = max(self._image_score(entry, image_hashes), self._text_score(entry, signature))
+                if score <= best_score:
+                    continue
+                if extract_payment_fields(entry.get('text')) != payment:
+                    self.logger.info(f"処理済みの {entry['file']} と類似していますが、支払日・支払金額が異なるため別の領収書として処理します")
+                    continue
+                best, best_score = entry, score
+        return best
+
+    @staticmethod
+    def _image_score(entry, image_hashes):
+        """全ページの画像ハッシュが近ければ 1.0、そうでなければ 0"""
+        known = entry.get('image_hashes')
+        if not image_hashes or not known or len(known) != len(image_hashes):
+            return 0
+        if all(bin(a ^ b).count('1') <= IMAGE_HASH_MAX_DISTANCE for a, b in zip(known, image_hashes)):
+            return 1.0
+        return 0
+
+    @staticmethod
+    def _text_score(entry, signature):
+        """MinHashによる推定Jaccard係数（閾値未満は 0）"""
+        known = entry.get('text_signature')
+        if not signature or not known:
+            return 0
+        score = sum(1 for a, b in zip(known, signature) if a == b) / len(signature)
+        return score if score >= TEXT_SIMILARITY_THRESHOLD else 0
+
+    def add(self, filename, image_hashes, text_signature, text, result):
+        with self.lock:
+            self.entries.append({
+                'id': uuid.uuid4().hex,
+                'file': filename,
+                'image_hashes': image_hashes,
+                'text_signature': text_signature,
+                'text': text,
+                'result': result,
+                'prompt_version': PROMPT_VERSION,
+            })
+
+    def save(self):
+        """ファイル上のインデックスとマージして保存する
+
+        複数ノード・複数プロセスが同じインデックスを更新しても互いのエントリを消さないよう、
+        ロックファイルで排他し、読み直したエントリに自分のエントリを加えてから置き換える。
+        """
+        with self.lock:
+            temp_path = None
+            try:
+                os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+                with open(f"{self.index_path}.lock", 'a') as lock_file:
+                    if fcntl:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX)
+                    try:
+                        merged = {self._entry_key(entry): entry for entry in self._load()}
+                        for entry in self.entries:
+                            merged.setdefault(self._entry_key(entry), entry)
+                        self.entries = list(merged.values())
+                        temp_path = f"{self.index_path}.{uuid.uuid4().hex}.tmp"
+                        with open(temp_path, 'w', encoding='utf-8') as f:
+                            json.dump({'entries': self.entries}, f, ensure_ascii=False)
+                        os.replace(temp_path, self.index_path)
+                        temp_path = None
+                    finally:
+                        if fcntl:
+                            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            except Exception as e:
+                self.logger.warning(f"類似検索インデックスの保存に失敗しました: {e}")
+            finally:
+                if temp_path and os.path.exists(temp_path):
+                    os.remove(temp_path)
+
+def extract_text_from_pages(file_path, image_paths, logger):
+    """各ページの画像からLLMでテキストを抽出し、結合して返す"""
+    all_text = []
+
+    for i, image_path in enumerate(image_paths, 1):
+        # 画像をBase64エンコード
+        base64_image = encode_image(image_path, logger)
+        if not base64_image:
+            continue
+
+        # テキスト抽出
+        response_text = llm_extract_text_from_image(
+            base64_image,
+            OCR_PROMPT.render(filename=os.path.basename(file_path), page=i, total=len(image_paths)),
+            logger)
+        all_text.append(response_text)
+
+    # 全ページのテキストを結合
+    return PAGE_SEPARATOR.join(all_text)
+
 def is_tax_format(filename):
     """確定申告フォーマットかどうかをチェック"""
     pattern = r'\d{4}-\d{2}-\d{2}_\d+円_.+\.(jpg|jpeg|pdf|png)$'
     return bool(re.match(pattern, filename.lower()))
 
-def process_file(file_path, args, logger, backup_dir):
+def claim_path(path):
+    """ファイルが存在しない場合のみ空のファイルを作成して確保する（他のスレッド・ノードと排他）"""
+    try:
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    os.close(fd)
+    return True
+
+def claim_output_paths(input_dir, filename_base, ext, source_path, with_text, logger):
+    """出力先のファイル名を、重複する場合は連番（_1, _2, ...）を付けて確保する
+
+    同じ日付・金額・支払先の領収書を並列に（または複数ノードで）処理しても上書きしないよう、
+    存在確認ではなく排他的な作成で名前を確保する。テキストファイルも同じ連番の名前で確保する。
+    (画像/PDFのパス, テキストファイルのパスまたは None) を返す。
+    """
+    counter = 0
+    while True:
+        base = filename_base if counter == 0 else f"{filename_base}_{counter}"
+        new_path = os.path.join(input_dir, f"{base}{ext}")
+        new_text_file = os.path.join(input_dir, f"{base}.txt") if with_text else None
+        if claim_path(new_path):
+            if new_text_file is None or claim_path(new_text_file):
+                return new_path, new_text_file
+            os.remove(new_path)
+        elif counter == 0 and is_same_file_content(source_path, new_path):
+            logger.info(f"同一ファイルが既に存在するため連番付きで保存します: {new_path}")
+        counter += 1
+
+def is_same_file_content(path1, path2):
+    try:
+        return os.path.getsize(path2) > 0 and filecmp.cmp(path1, path2, shallow=False)
+    except OSError:
+        return False
+
+def process_file(file_path, args, logger, backup_dir, similarity_index=None, batcher=None):
     # 確定申告フォーマットのチェック
     if is_tax_format(os.path.basename(file_path)):
         print(f"スキップ: {os.path.basename(file_path)} (確定申告フォーマット)")
         return
 
     start_time = datetime.now()
+    previous_deadline = current_deadline()
+    deadline = Deadline(args.file_timeout, parent=previous_deadline or _run_deadline)
+    _deadline_local.deadline = deadline
     try:
         # 入力ファイルのディレクトリを取得
         input_dir = os.path.dirname(os.path.abspath(file_path))
         base, ext = os.path.splitext(file_path)
         temp_dir = None
         temp_files = []
+        deadline.check()
 
         # 既存のテキストファイルをチェック
         text_file = f"{base}.txt"
         extracted_text = None
+        image_hashes = None
+        text_signature = None
+        duplicate = None
         if os.path.exists(text_file):
             logger.info(f"既存のテキストファイルを使用します: {text_file}")
             extracted_text = load_existing_text(text_file, logger)
@@ -385,59 +1728,16 @@ def process_file(file_path, args, logger, backup_dir):
                 temp_dir = tempfile.mkdtemp()
                 temp_files = pdf_to_jpeg(file_path, temp_dir, logger)
                 if not temp_files:
+                    deadline.check()
                     return
             else:
                 temp_files = [file_path]
 
-            # 全ページのテキストを結合
-            all_text = []
-            
-            for i, image_path in enumerate(temp_files, 1):
-                # 画像をBase64エンコード
-                base64_image = encode_image(image_path, logger)
-                if not base64_image:
-                    continue
+            # 画像の類似は重複の候補を探すためだけに使う（支払い情報の照合にOCRが必要）
+            if similarity_index is not None:
+                image_hashes = compute_image_hashes(temp_files, logger)
 
-                # テキスト抽出
-                response_text = llm_extract_text_from_image(
-                    base64_image,
-                    """この領収書の内容を読み取ってください。
-                    以下の形式で回答してください：
-
-                    ※重要な指示：
-                    和暦の年号は以下のように西暦に変換してください：
-                    - 令和元年 = 2019年
-                    - 令和2年 = 2020年
-                    - 令和3年 = 2021年
-                    - 令和4年 = 2022年
-                    - 令和5年 = 2023年
-                    - 令和6年 = 2024年
-                    - 令和7年 = 2025年
-                    ※ "R06" "R6" "令6"なども令和6年として認識してください。
-                    ※ 登録番号などに含まれる"R06"も令和6年を表す可能性があります。
-                    ※ 和暦は令和しかありません。そのため、数字一桁なら令和の年号です。
-
-                    @入力ファイル名
-                    """ + os.path.basename(file_path) + f"""
-                    @ページ番号: {i}/{len(temp_files)}
-
-                    ---OCRデータ---
-                    [読み取ったテキストをそのまま出力してください]
-
-                    ---支払い情報---
-                    支払日：[支払日を記載（和暦は上記の通り西暦に変換）]
-                    支払先：[支払先の正式名称]
-                    支払金額：[支払金額を数字のみで記載]
-                    摘要：[支払内容や品目名]
-
-                    ---その他の情報---
-                    [その他の重要な情報を箇条書きで記述]
-                    """
-                , logger)
-                all_text.append(response_text)
-
-            # 全ページのテキストを結合
-            extracted_text = "\n\n=== ページの区切り ===\n\n".join(all_text)
+            extracted_text = extract_text_from_pages(file_path, temp_files, logger)
 
             # LLMの回答を一時的に保存
             if not args.no_text and extracted_text:
@@ -449,8 +1749,24 @@ def process_file(file_path, args, logger, backup_dir):
             logger.info("抽出されたテキスト:")
             logger.info(extracted_text)
 
-        # 情報抽出
-        result = llm_extract_structured_text(generate_question(extracted_text, args.year), logger)
+        # 処理済みの領収書と類似し、支払日・支払金額も一致していれば抽出結果を再利用する
+        if similarity_index is not None:
+            text_signature = compute_text_signature(extracted_text)
+            duplicate = similarity_index.find_duplicate(image_hashes, text_signature, extracted_text)
+
+        if duplicate:
+            duplicate_message = f"[重複の可能性] {os.path.basename(file_path)}: 処理済みの {duplicate['file']} と類似し、支払日・支払金額が一致しています（抽出結果を再利用）"
+            print(duplicate_message)
+            logger.warning(duplicate_message)
+            result = duplicate['result']
+        elif batcher is not None:
+            # 他のファイルとまとめて情報抽出
+            result = batcher.extract(os.path.basename(file_path), extracted_text)
+        else:
+            # 情報抽出
+            result = llm_extract_structured_text(generate_question(extracted_text, args.year, logger), logger)
+
+        deadline.check()
 
         if args.debug:
             logger.debug("解析結果:")
@@ -499,53 +1815,46 @@ def process_file(file_path, args, logger, backup_dir):
             # 新しいファイル名のベース部分（拡張子なし）
             new_filename_base = f"{date_formatted}_{amount}円_{company_name}"
             
-            # 画像/PDFファイルの新しいパス
-            new_path = os.path.join(input_dir, f"{new_filename_base}{ext}")
-            
-            # ファイル名の重複チェックと連番付与
-            counter = 1
-            original_new_path = new_path
-            while os.path.exists(new_path):
-                # 既存のファイルと完全に同じ内容かチェック
-                if os.path.exists(new_path) and os.path.getsize(file_path) == os.path.getsize(new_path):
-                    with open(file_path, 'rb') as f1, open(new_path, 'rb') as f2:
-                        if f1.read() == f2.read():
-                            # 同一ファイルの場合は連番を付与
-                            base_no_ext = os.path.splitext(original_new_path)[0]
-                            new_path = f"{base_no_ext}_{counter}{ext}"
-                            counter += 1
-                            logger.info(f"同一ファイルを連番付きで保存します: {new_path}")
-                            break
-                
-                # 異なるファイルの場合は連番を付与
-                base_no_ext = os.path.splitext(original_new_path)[0]
-                new_path = f"{base_no_ext}_{counter}{ext}"
-                counter += 1
+            # ここから先のファイル操作は途中で中断しない
+            deadline.check()
 
             # 元ファイルをバックアップディレクトリに移動
             backup_success, backup_path = backup_file(file_path, backup_dir, logger)
             if not backup_success:
                 return
 
-            # テキストファイルの処理
-            if os.path.exists(text_file) and not args.no_text:
-                # 新しい名前のテキストファイル
-                new_text_file = os.path.join(input_dir, f"{new_filename_base}.txt")
-                # テキストファイルを新しい名前で保存
-                shutil.copy2(text_file, new_text_file)
-                # 元のテキストファイルをバックアップ
-                backup_file(text_file, backup_dir, logger)
-                logger.info(f"テキストファイルを保存しました: {new_text_file}")
-            
-            # 処理済みファイルを元のディレクトリにコピー
-            shutil.copy2(backup_path, new_path)
-            logger.info(f"処理済みファイルを保存しました: {new_path}")
-            
-            # ログ出力
-            log_file = os.path.join(input_dir, "receipt_log.csv")
-            with open(log_file, mode="a", newline="", encoding="utf-8") as f:
-                writer = csv.writer(f)
-                writer.writerow([new_path])
+            # 途中で失敗した場合に元の状態へ戻すための記録
+            moved_files = [(file_path, backup_path)]
+            created_files = []
+            try:
+                # 新しいファイル名（重複する場合は連番付き）を確保
+                new_path, new_text_file = claim_output_paths(
+                    input_dir, new_filename_base, ext, backup_path,
+                    os.path.exists(text_file) and not args.no_text, logger)
+                created_files.append(new_path)
+                if new_text_file:
+                    created_files.append(new_text_file)
+
+                # テキストファイルの処理
+                if new_text_file:
+                    # テキストファイルを新しい名前で保存
+                    shutil.copy2(text_file, new_text_file)
+                    # 元のテキストファイルをバックアップ
+                    text_backup_success, text_backup_path = backup_file(text_file, backup_dir, logger)
+                    if text_backup_success:
+                        moved_files.append((text_file, text_backup_path))
+                    logger.info(f"テキストファイルを保存しました: {new_text_file}")
+
+                # 処理済みファイルを元のディレクトリにコピー
+                shutil.copy2(backup_path, new_path)
+                logger.info(f"処理済みファイルを保存しました: {new_path}")
+
+                # ログ出力
+                log_file = os.path.join(input_dir, "receipt_log.csv")
+                append_receipt_log(log_file, new_path)
+            except BaseException:
+                rollback_file_operations(moved_files, created_files, logger)
+                raise
 
             # 処理時間の計算
             elapsed_time = datetime.now() - start_time
@@ -559,9 +1868,22 @@ def process_file(file_path, args, logger, backup_dir):
             # 詳細情報の表示（-vオプション時のみ）
             if args.verbose:
                 print(f"  保存場所: {new_path}")
-                if not args.no_text:
+                if new_text_file:
                     print(f"  テキストファイル: {new_text_file}")
 
+            if similarity_index is not None:
+                similarity_index.add(os.path.basename(new_path), image_hashes, text_signature, extracted_text, result)
+
+            return new_path
+
+    except ProcessingCancelled as e:
+        # 中断されたファイルは元の場所に残っているため、次回の実行で処理される
+        error_message = f"[処理時間 {(datetime.now() - start_time).total_seconds():.2f}秒] 中断：{os.path.basename(file_path)}（{e}）"
+        print(error_message)
+        logger.warning(error_message)
+        if not isinstance(e, LeaseLost):
+            deadline.record_unfinished(file_path)
+
     except Exception as e:
         # エラーメッセージを簡略化
         error_type = "日付エラー" if "time data" in str(e) else "処理エラー"
@@ -576,6 +1898,7 @@ def process_file(file_path, args, logger, backup_dir):
             logger.info(f"エラー時のテキストを保存しました: {text_file}")
     
     finally:
+        _deadline_local.deadline = previous_deadline
         # 一時ファイル・ディレクトリの削除
         if temp_dir and os.path.exists(temp_dir):
             try:
@@ -583,7 +1906,411 @@ def process_file(file_path, args, logger, backup_dir):
             except Exception as e:
                 logger.warning(f"一時ディレクトリの削除に失敗しました: {e}")
 
+class ReceiptDaemon:
+    """プロバイダ設定やキャッシュを保持したまま、投入されたファイルを処理する常駐プロセス"""
+
+    def __init__(self, args, logger):
+        self.args = args
+        self.logger = logger
+        self.upload_dir = os.path.expanduser(args.upload_dir)
+        self.started_at = datetime.now().strftime('%Y%m%d_%H%M%S')
+        self.jobs = {}
+        self.job_deadlines = {}
+        self.backup_dirs = {}
+        self.lock = threading.Lock()
+        budget_bytes = args.memory_budget * 1024 * 1024 if args.memory_budget else default_memory_budget()
+        self.memory_budget = MemoryBudget(budget_bytes)
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(multiprocessing.cpu_count(), LLM_MAX_CONCURRENCY))
+        self.similarity_index = None
+        if args.dedup:
+            self.similarity_index = SimilarityIndex(
+                os.path.expanduser(args.dedup_index or DEFAULT_DAEMON_SIMILARITY_INDEX), logger)
+
+    def get_backup_dir(self, file_path):
+        """ディレクトリごとに常駐プロセスの起動時刻のバックアップディレクトリを使う"""
+        input_dir = os.path.dirname(os.path.abspath(file_path))
+        with self.lock:
+            backup_dir = self.backup_dirs.get(input_dir)
+            if backup_dir is None:
+                backup_dir = os.path.join(input_dir, f"backup_{self.started_at}")
+                os.makedirs(backup_dir, exist_ok=True)
+                self.logger.info(f"バックアップディレクトリを作成しました: {backup_dir}")
+                self.backup_dirs[input_dir] = backup_dir
+        return backup_dir
+
+    def submit(self, file_path, year=None, no_text=None, backup_dir=None, file_timeout=None, deadline=None):
+        """処理ジョブを登録し、ジョブIDを返す
+
+        deadline はジョブ全体の処理時間の上限（秒）で、クライアント側の --deadline の残り時間を受け取る。
+        """
+        job_id = uuid.uuid4().hex
+        job = {
+            'id': job_id,
+            'status': 'queued',
+            'path': file_path,
+            'new_name': None,
+            'new_path': None,
+            'elapsed': None,
+            'finished_at': None,
+        }
+        job_args = argparse.Namespace(**vars(self.args))
+        job_args.year = year
+        if no_text is not None:
+            job_args.no_text = no_text
+        if file_timeout is not None:
+            job_args.file_timeout = file_timeout
+        job_deadline = Deadline(deadline)
+        with self.lock:
+            self._evict_finished_jobs()
+            self.jobs[job_id] = job
+            self.job_deadlines[job_id] = job_deadline
+        self.executor.submit(self._run, job, job_args, backup_dir, job_deadline)
+        return job_id
+
+    def _evict_finished_jobs(self):
+        """結果の保持期間を過ぎた完了済みジョブを削除する（self.lock を保持して呼ぶ）"""
+        expires_before = time.time() - DAEMON_JOB_RETENTION_SECONDS
+        for job_id in [job_id for job_id, job in self.jobs.items()
+                       if job['finished_at'] is not None and job['finished_at'] < expires_before]:
+            del self.jobs[job_id]
+            del self.job_deadlines[job_id]
+
+    def cancel(self, job_id):
+        """ジョブの中断を要求する。ジョブが存在しない場合は False を返す"""
+        with self.lock:
+            job_deadline = self.job_deadlines.get(job_id)
+        if job_deadline is None:
+            return False
+        job_deadline.cancel()
+        return True
+
+    def _run(self, job, job_args, backup_dir, job_deadline):
+        start_time = time.time()
+        with self.lock:
+            job['status'] = 'running'
+        # 処理中のファイルの期限はジョブの期限を親とするため、中断要求や期限切れが伝わる
+        _deadline_local.deadline = job_deadline
+        try:
+            if is_tax_format(os.path.basename(job['path'])):
+                status, new_path = 'skipped', None
+            else:
+                if not backup_dir:
+                    backup_dir = self.get_backup_dir(job['path'])
+                new_path = process_file_with_budget(job['path'], job_args, self.logger, backup_dir,
+                                                    self.memory_budget, self.similarity_index)
+                if new_path:
+                    status = 'done'
+                else:
+                    status = 'cancelled' if job_deadline.unfinished else 'failed'
+                if new_path and self.similarity_index is not None:
+                    self.similarity_index.save()
+        except Exception as e:
+            self.logger.error(f"ジョブの処理中にエラーが発生しました: {job['path']}: {e}")
+            status, new_path = 'failed', None
+        finally:
+            _deadline_local.deadline = None
+        with self.lock:
+            job['status'] = status
+            job['new_path'] = new_path
+            job['new_name'] = os.path.basename(new_path) if new_path else None
+            job['elapsed'] = time.time() - start_time
+            job['finished_at'] = time.time()
+
+    def get_job(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job else None
+
+    @staticmethod
+    def check_file_type(filename):
+        if not filename.lower().endswith(('.pdf', '.jpg', '.jpeg', '.png')):
+            raise ValueError(f"未対応のファイル形式です: {filename}")
+
+    @staticmethod
+    def allowed_backup_dir(file_path, backup_dir):
+        """クライアントが指定したバックアップ先は、対象ファイルのディレクトリ配下の場合のみ使う"""
+        if not backup_dir:
+            return None
+        input_dir = os.path.realpath(os.path.dirname(file_path))
+        backup_dir = os.path.realpath(backup_dir)
+        if backup_dir != input_dir and os.path.commonpath([input_dir, backup_dir]) == input_dir:
+            return backup_dir
+        return None
+
+    def save_upload(self, filename, data):
+        """アップロードされたファイルを保存し、そのパスを返す"""
+        filename = os.path.basename(filename)
+        self.check_file_type(filename)
+        upload_dir = os.path.join(self.upload_dir, uuid.uuid4().hex)
+        os.makedirs(upload_dir, exist_ok=True)
+        upload_path = os.path.join(upload_dir, filename)
+        with open(upload_path, 'wb') as f:
+            f.write(data)
+        return upload_path
+
+class RequestTooLarge(Exception):
+    """常駐モードのリクエスト本文が上限を超えている"""
+
+class ReceiptRequestHandler(BaseHTTPRequestHandler):
+    """常駐モードのHTTP API
+
+    GET  /health         : 稼働確認
+    POST /jobs           : JSON {"path": ..., "year": [...], "no_text": ..., "backup_dir": ...,
+                           "file_timeout": ..., "deadline": ...} でファイルを投入
+                           （backup_dir は対象ファイルのディレクトリ配下のみ有効）
+    POST /uploads?filename=...&year=... : リクエスト本文のファイルを保存して投入
+                           （Content-Type は application/octet-stream などのファイル形式）
+    GET  /jobs/<id>      : ジョブの状態と新しいファイル名を取得
+    POST /jobs/<id>/cancel : ジョブの中断を要求
+    """
+
+    receipt_daemon = None
+
+    def _send_json(self, status, body):
+        data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _read_body(self, max_bytes=None):
+        length = int(self.headers.get('Content-Length', 0))
+        if max_bytes is not None and length > max_bytes:
+            raise RequestTooLarge(f"リクエストが大きすぎます（上限 {max_bytes // 1024 // 1024}MB）")
+        return self.rfile.read(length) if length > 0 else b''
+
+    def _content_type(self):
+        return self.headers.get('Content-Type', '').split(';')[0].strip().lower()
+
+    def _check_request_origin(self, allowed_types):
+        """ブラウザ上の任意のWebページからの要求（CORSの単純リクエスト）を拒否する"""
+        if self.headers.get('Origin'):
+            return 'ブラウザからの要求は受け付けません'
+        if self._content_type() not in allowed_types:
+            return f"Content-Type は {' / '.join(allowed_types)} のみ受け付けます"
+        return None
+
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        if path == '/health':
+            self._send_json(200, {
+                'status': 'ok',
+                'provider': LLM_PROVIDER,
+                'llm_concurrency': int(LLM_LIMITER.limit) if LLM_LIMITER else None,
+            })
+            return
+        if path.startswith('/jobs/'):
+            job = self.receipt_daemon.get_job(path[len('/jobs/'):])
+            if job is None:
+                self._send_json(404, {'error': 'ジョブが見つかりません'})
+                return
+            self._send_json(200, job)
+            return
+        self._send_json(404, {'error': '不明なパスです'})
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        allowed_types = DAEMON_UPLOAD_CONTENT_TYPES if url.path == '/uploads' else (DAEMON_JSON_CONTENT_TYPE,)
+        rejection = self._check_request_origin(allowed_types)
+        if rejection:
+            self._send_json(415 if not self.headers.get('Origin') else 403, {'error': rejection})
+            return
+        try:
+            if url.path.startswith('/jobs/') and url.path.endswith('/cancel'):
+                job_id = url.path[len('/jobs/'):-len('/cancel')]
+                if not self.receipt_daemon.cancel(job_id):
+                    self._send_json(404, {'error': 'ジョブが見つかりません'})
+                    return
+                self._send_json(202, {'id': job_id, 'status': 'cancelling'})
+                return
+            if url.path == '/jobs':
+                request_body = json.loads(self._read_body().decode('utf-8') or '{}')
+                file_path = request_body.get('path')
+                if not file_path or not os.path.isfile(file_path):
+                    self._send_json(400, {'error': f'ファイルが見つかりません: {file_path}'})
+                    return
+                self.receipt_daemon.check_file_type(file_path)
+                file_path = os.path.abspath(file_path)
+                job_id = self.receipt_daemon.submit(
+                    file_path,
+                    year=normalize_years(request_body.get('year')),
+                    no_text=request_body.get('no_text'),
+                    backup_dir=self.receipt_daemon.allowed_backup_dir(file_path, request_body.get('backup_dir')),
+                    file_timeout=request_body.get('file_timeout'),
+                    deadline=request_body.get('deadline'),
+                )
+            elif url.path == '/uploads':
+                query = parse_qs(url.query)
+                filename = query.get('filename', [''])[0]
+                year = [int(y) for y in query.get('year', [])] or None
+                upload_path = self.receipt_daemon.save_upload(filename, self._read_body(DAEMON_MAX_UPLOAD_BYTES))
+                job_id = self.receipt_daemon.submit(upload_path, year=year)
+            else:
+                self._send_json(404, {'error': '不明なパスです'})
+                return
+        except RequestTooLarge as e:
+            self._send_json(413, {'error': str(e)})
+            self.close_connection = True
+            return
+        except (ValueError, TypeError, json.JSONDecodeError) as e:
+            self._send_json(400, {'error': str(e)})
+            return
+        self._send_json(202, {'id': job_id, 'status': 'queued'})
+
+    def log_message(self, format, *args):
+        self.receipt_daemon.logger.debug(f"HTTP {self.address_string()} {format % args}")
+
+def normalize_years(year):
+    """JSONで受け取った年の指定を --year と同じ整数のリストに揃える（2024, "2024", [2024] のいずれも可）"""
+    if year is None or year == []:
+        return None
+    if not isinstance(year, list):
+        year = [year]
+    return [int(y) for y in year]
+
+def serve(args, logger):
+    """常駐モードで起動"""
+    if args.daemon_host not in LOOPBACK_HOSTS:
+        # APIには認証がなく、任意のパスのファイルを処理・移動できるため
+        if not args.daemon_allow_remote:
+            logger.error(f"ローカルホスト以外での待ち受けは許可されていません: {args.daemon_host}"
+                         "（認証がないため。許可する場合は --daemon-allow-remote を指定）")
+            sys.exit(1)
+        logger.warning(f"ローカルホスト以外で待ち受けます: {args.daemon_host}"
+                       "（認証がないため、信頼できるネットワークでのみ使用してください）")
+    daemon = ReceiptDaemon(args, logger)
+    ReceiptRequestHandler.receipt_daemon = daemon
+    server = ThreadingHTTPServer((args.daemon_host, args.daemon_port), ReceiptRequestHandler)
+    print(f"常駐モードで起動しました: http://{args.daemon_host}:{args.daemon_port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("常駐モードを終了します")
+    finally:
+        server.server_close()
+        daemon.executor.shutdown(wait=True)
+
+def daemon_request(daemon_url, method, path, body=None, timeout=LLM_TIMEOUT_SECONDS):
+    data = json.dumps(body, ensure_ascii=False).encode('utf-8') if body is not None else None
+    req = request.Request(
+        url=f"{daemon_url}{path}",
+        data=data,
+        headers={"Content-Type": "application/json"},
+        method=method,
+    )
+    with request.urlopen(req, timeout=timeout) as resp:
+        return json.loads(resp.read().decode('utf-8'))
+
+def find_running_daemon(args):
+    """常駐プロセスが起動していればそのURLを返す"""
+    daemon_url = f"http://{args.daemon_host}:{args.daemon_port}"
+    try:
+        health = daemon_request(daemon_url, "GET", "/health", timeout=1)
+    except Exception:
+        return None
+    return daemon_url if health.get('status') == 'ok' else None
+
+def daemon_unsupported_options(args):
+    """常駐プロセスに処理を依頼すると反映されないオプションの一覧"""
+    options = []
+    if args.dedup:
+        options.append('--dedup')
+    if args.batch_extract:
+        options.append('--batch-extract')
+    if args.memory_budget:
+        options.append('--memory-budget')
+    if args.debug:
+        options.append('--debug')
+    return options
+
+def cancel_daemon_jobs(job_ids, logger, daemon_url):
+    """常駐プロセスに投入したジョブの中断を要求する"""
+    for job_id in job_ids:
+        try:
+            daemon_request(daemon_url, "POST", f"/jobs/{job_id}/cancel")
+        except Exception as e:
+            logger.error(f"常駐プロセスへの中断要求に失敗しました: {job_id}: {e}")
+
+def process_files_via_daemon(file_paths, args, logger, backup_dir, daemon_url):
+    """常駐プロセスに処理を依頼し、結果を待って表示する（シンクライアント）
+
+    --file-timeout と --deadline の残り時間はジョブごとに常駐プロセスへ渡し、
+    Ctrl-C で中断した場合は処理中のジョブにも中断を要求する。
+    """
+    pending = {}
+    for index, file_path in enumerate(file_paths):
+        if _run_deadline.expired():
+            for unfinished_file in file_paths[index:]:
+                _run_deadline.record_unfinished(unfinished_file)
+            break
+        try:
+            response = daemon_request(daemon_url, "POST", "/jobs", {
+                'path': os.path.abspath(file_path),
+                'year': args.year,
+                'no_text': args.no_text,
+                'backup_dir': backup_dir,
+                'file_timeout': args.file_timeout,
+                'deadline': _run_deadline.remaining(),
+            })
+            pending[response['id']] = file_path
+        except Exception as e:
+            logger.error(f"常駐プロセスへの投入に失敗しました: {file_path}: {e}")
+            print(f"処理エラー：{os.path.basename(file_path)}")
+
+    while pending:
+        try:
+            time.sleep(DAEMON_POLL_INTERVAL_SECONDS)
+        except KeyboardInterrupt:
+            # 処理中のジョブは次の確認点で中断され、元の状態に戻されるまで待つ
+            print("中断が要求されました。常駐プロセスの処理を停止しています...")
+            _run_deadline.cancel()
+            cancel_daemon_jobs(list(pending), logger, daemon_url)
+            continue
+        for job_id, file_path in list(pending.items()):
+            try:
+                job = daemon_request(daemon_url, "GET", f"/jobs/{job_id}")
+            except Exception as e:
+                logger.error(f"常駐プロセスからの結果取得に失敗しました: {file_path}: {e}")
+                del pending[job_id]
+                continue
+            if job['status'] in ('queued', 'running'):
+                continue
+            del pending[job_id]
+            if job['status'] == 'done':
+                print(f"[処理時間 {job['elapsed']:.2f}秒] 変更前：{os.path.basename(file_path)} -> 変更後：{job['new_name']}")
+                if args.verbose:
+                    print(f"  保存場所: {job['new_path']}")
+            elif job['status'] == 'skipped':
+                print(f"スキップ: {os.path.basename(file_path)} (確定申告フォーマット)")
+            elif job['status'] == 'cancelled':
+                print(f"[処理時間 {job['elapsed']:.2f}秒] 中断：{os.path.basename(file_path)}")
+                _run_deadline.record_unfinished(file_path)
+            else:
+                print(f"[処理時間 {job['elapsed']:.2f}秒] 処理エラー：{os.path.basename(file_path)}")
+
+def report_unfinished(file_paths, base_dir, logger):
+    """未完了のファイルを表示し、次回の実行用に一覧を保存する"""
+    unfinished_list = os.path.join(base_dir, UNFINISHED_LIST_NAME)
+    file_paths = [file_path for file_path in file_paths if os.path.exists(file_path)]
+    if not file_paths:
+        if os.path.exists(unfinished_list):
+            os.remove(unfinished_list)
+        return
+    print(f"未完了のファイル: {len(file_paths)}件（元の場所に残っています）")
+    for file_path in file_paths:
+        print(f"  {file_path}")
+    try:
+        with open(unfinished_list, 'w', encoding='utf-8') as f:
+            f.writelines(f"{os.path.abspath(file_path)}\n" for file_path in file_paths)
+        print(f"未完了のファイル一覧を保存しました: {unfinished_list}")
+    except Exception as e:
+        logger.error(f"未完了のファイル一覧の保存に失敗しました: {e}")
+
 def main():
+    global _run_deadline
+
     # コマンドライン引数を前処理
     args_list = sys.argv[1:]
     
@@ -637,8 +2364,27 @@ def main():
     args = parse_arguments()
     logger = setup_logging(args.debug, args.verbose)
 
-    # LLM設定（gemini / openwebui）
-    initialize_llm(logger)
+    if args.serve:
+        load_processing_modules()
+        initialize_llm(logger)
+        serve(args, logger)
+        return
+
+    # 常駐プロセスが起動していれば処理を依頼する（LLMの初期化は不要）
+    daemon_url = None
+    if not args.no_daemon and not args.distributed:
+        daemon_url = find_running_daemon(args)
+    unsupported_options = daemon_unsupported_options(args)
+    if daemon_url and unsupported_options:
+        # 黙って無視しないよう、常駐プロセスを使わずにこのプロセスで処理する
+        print(f"常駐プロセスでは {' '.join(unsupported_options)} を反映できないため、このプロセスで処理します")
+        daemon_url = None
+    if daemon_url:
+        logger.info(f"常駐プロセスを使用します: {daemon_url}")
+    else:
+        load_processing_modules()
+        # LLM設定（gemini / openwebui）
+        initialize_llm(logger)
     
     # 処理対象ファイルのリストを作成
     target_files = []
@@ -677,8 +2423,23 @@ def main():
         print(f"スキップ対象: {skipped_files}件（確定申告フォーマット）")
     print(f"処理実行数: {len(valid_files)}件")
 
+    # 複数ノード処理用のリースストア
+    lease_store = None
+    backup_suffix = ""
+    if args.distributed:
+        node_id = args.node_id or f"{socket.gethostname()}:{os.getpid()}"
+        lease_db = os.path.expanduser(args.lease_db) if args.lease_db else os.path.join(base_dir, DEFAULT_LEASE_DB_NAME)
+        try:
+            lease_store = LeaseStore(lease_db, node_id, args.lease_ttl, logger)
+        except sqlite3.Error as e:
+            logger.error(f"リースDBを開けませんでした: {lease_db}: {e}")
+            sys.exit(1)
+        # 同時刻に起動した別ノードとバックアップディレクトリが衝突しないようにする
+        backup_suffix = "_" + re.sub(r'[^\w.-]', '-', node_id)
+        print(f"分散処理モード: ノードID={node_id}, リースDB={lease_store.db_path}")
+
     # 共通のバックアップディレクトリを作成
-    backup_dir = os.path.join(base_dir, f"backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}")
+    backup_dir = os.path.join(base_dir, f"backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}{backup_suffix}")
     try:
         os.makedirs(backup_dir, exist_ok=True)
         logger.info(f"バックアップディレクトリを作成しました: {backup_dir}")
@@ -686,19 +2447,90 @@ def main():
         logger.error(f"バックアップディレクトリの作成に失敗しました: {e}")
         sys.exit(1)
     
-    if len(valid_files) > 0:
-        max_workers = min(multiprocessing.cpu_count(), len(valid_files))
+    # 類似検索インデックス（重複の可能性がある領収書の検出）
+    similarity_index = None
+    if args.dedup and not daemon_url:
+        index_path = os.path.expanduser(args.dedup_index) if args.dedup_index else os.path.join(base_dir, SIMILARITY_INDEX_NAME)
+        similarity_index = SimilarityIndex(index_path, logger)
+
+    # 実行全体の期限（Ctrl-C による中断もこの期限で扱う）
+    _run_deadline = Deadline(args.deadline)
+
+    if daemon_url and len(valid_files) > 0:
+        process_files_via_daemon(valid_files, args, logger, backup_dir, daemon_url)
+    elif len(valid_files) > 0:
+        # LLM呼び出しの同時実行数は自動調整するため、ワーカー数はその上限まで確保する
+        max_workers = min(max(multiprocessing.cpu_count(), LLM_MAX_CONCURRENCY), len(valid_files))
         if max_workers > 1:
-            print(f"並列処理を開始します（ワーカー数: {max_workers}）")
-            with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            budget_bytes = args.memory_budget * 1024 * 1024 if args.memory_budget else default_memory_budget()
+            memory_budget = MemoryBudget(budget_bytes)
+            cached_files, heavy_files = schedule_files(valid_files, logger)
+            # 複数ファイルのテキスト抽出をまとめる
+            batcher = None
+            if args.batch_extract:
+                batcher = StructuredExtractionBatcher(args.year, logger, args.batch_max_tokens)
+            print(f"並列処理を開始します（ワーカー数: {max_workers}、メモリ予算: {budget_bytes // 1024 // 1024}MB）")
+            if cached_files:
+                print(f"OCR済みファイル: {len(cached_files)}件（高速レーンで処理）")
+            with concurrent.futures.ThreadPoolExecutor(max_workers=FAST_LANE_WORKERS) as fast_executor, \
+                    concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+                # OCR済みファイルは重いファイルの後ろに並ばせず、即座に別レーンで処理する
+                futures = {fast_executor.submit(run_file_task, file, lease_store, logger,
+                                                process_file, args, logger, backup_dir, similarity_index,
+                                                batcher): file
+                           for file in cached_files}
+                # 重いファイルから順に投入し、最後に長時間のファイルが残らないようにする
                 # バックアップディレクトリを引数として渡す
-                futures = [executor.submit(process_file, file, args, logger, backup_dir) for file in valid_files]
-                concurrent.futures.wait(futures)
+                futures.update({executor.submit(run_file_task, file, lease_store, logger,
+                                                process_file_with_budget, args, logger, backup_dir, memory_budget,
+                                                similarity_index, batcher): file
+                                for file in heavy_files})
+                try:
+                    concurrent.futures.wait(futures)
+                except KeyboardInterrupt:
+                    # 未着手のファイルは取り消し、処理中のファイルは次の確認点で中断させる
+                    print("中断が要求されました。処理中のファイルを停止しています...")
+                    _run_deadline.cancel()
+                    fast_executor.shutdown(wait=False, cancel_futures=True)
+                    executor.shutdown(wait=False, cancel_futures=True)
+            if batcher is not None:
+                batcher.close()
+            for future, file in futures.items():
+                if future.cancelled():
+                    _run_deadline.record_unfinished(file)
+            unclaimed_files = [futures[future] for future in futures
+                               if not future.cancelled() and future.exception() is None
+                               and not future.result()[0]]
         else:
-            for file in valid_files:
-                # バックアップディレクトリを引数として渡す
-                process_file(file, args, logger, backup_dir)
+            unclaimed_files = []
+            for index, file in enumerate(valid_files):
+                try:
+                    # バックアップディレクトリを引数として渡す
+                    claimed, _ = run_file_task(file, lease_store, logger, process_file, args, logger, backup_dir,
+                                               similarity_index)
+                except KeyboardInterrupt:
+                    print("中断が要求されました")
+                    _run_deadline.cancel()
+                    for unfinished_file in valid_files[index:]:
+                        _run_deadline.record_unfinished(unfinished_file)
+                    break
+                if not claimed:
+                    unclaimed_files.append(file)
+
+        if lease_store and unclaimed_files and not _run_deadline.expired():
+            wait_for_other_nodes(unclaimed_files, lease_store, logger, process_file, args, logger, backup_dir,
+                                 similarity_index)
+
+    if similarity_index is not None:
+        similarity_index.save()
 
+    if LLM_LIMITER is not None and LLM_LIMITER.successes + LLM_LIMITER.failures > 0:
+        print(LLM_LIMITER.summary())
+
+    report_unfinished(_run_deadline.unfinished, base_dir, logger)
+    if _run_deadline.unfinished:
+        print("処理を中断しました")
+        sys.exit(1)
     print("すべての処理が完了しました")
 
 if __name__ == "__main__":
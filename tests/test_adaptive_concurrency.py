@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""AdaptiveConcurrencyLimiter（LLM同時実行数の自動調整）のテスト"""
+
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import receipt_rename  # noqa: E402
+
+
+class AdaptiveConcurrencyLimiterTest(unittest.TestCase):
+    def setUp(self):
+        self.limiter = receipt_rename.AdaptiveConcurrencyLimiter(16, logging.getLogger(__name__))
+
+    def record(self, kind, latency, ok=True):
+        """応答時間 latency 秒のリクエストを1件記録する"""
+        started_at, solo = self.limiter.acquire()
+        self.limiter.release(kind, (started_at - latency, solo), ok)
+
+    def test_varied_latency_without_contention_keeps_limit(self):
+        # 出力長や画像サイズによる応答時間のばらつき（最大4倍）だけでは同時実行数を減らさない
+        def worker():
+            rng = random.Random(threading.get_ident())
+            for _ in range(10):
+                self.limiter.call('image', time.sleep, rng.uniform(0.05, 0.2))
+
+        threads = [threading.Thread(target=worker) for _ in range(16)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertGreaterEqual(int(self.limiter.limit), 12)
+        self.assertEqual(self.limiter.failures, 0)
+
+    def test_serialized_backend_keeps_limit_small(self):
+        # 1件ずつしか処理できないバックエンド（単一GPUのOllamaなど）では、並列に送っても順番待ちが増えるだけ
+        backend = threading.Lock()
+        limits = []
+
+        def serialized_backend():
+            with backend:
+                time.sleep(0.02)
+
+        def worker():
+            for _ in range(10):
+                self.limiter.call('image', serialized_backend)
+                limits.append(self.limiter.limit)
+
+        threads = [threading.Thread(target=worker) for _ in range(16)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        settled = limits[len(limits) // 2:]
+        self.assertLessEqual(sum(settled) / len(settled), 4)
+        self.assertEqual(self.limiter.failures, 0)
+
+    def test_batch_calls_do_not_count_as_congestion_for_single_calls(self):
+        rng = random.Random(0)
+        for _ in range(100):
+            self.record('text', rng.uniform(0.5, 1.5))
+            self.record('text_batch', rng.uniform(8.0, 15.0))
+        self.assertEqual(int(self.limiter.limit), 16)
+
+    def test_sustained_slowdown_reduces_limit(self):
+        rng = random.Random(0)
+        for _ in range(50):
+            self.record('image', rng.uniform(0.5, 1.5))
+        self.assertEqual(int(self.limiter.limit), 16)
+        for _ in range(10):
+            self.record('image', rng.uniform(4.0, 6.0))
+        self.assertLess(int(self.limiter.limit), 16)
+
+    def test_abandoned_request_is_not_counted_as_failure(self):
+        for _ in range(20):
+            self.record('text', 1.0)
+        receipt_rename.LLM_LIMITER = self.limiter
+        self.addCleanup(setattr, receipt_rename, 'LLM_LIMITER', None)
+
+        def request_timing_out_after_deadline():
+            time.sleep(0.5)
+            raise TimeoutError("timed out")
+
+        receipt_rename._deadline_local.deadline = receipt_rename.Deadline(0.2)
+        self.addCleanup(setattr, receipt_rename._deadline_local, 'deadline', None)
+        with self.assertRaises(receipt_rename.ProcessingCancelled):
+            receipt_rename.run_cancellable(
+                receipt_rename.call_with_llm_limit, 'text', request_timing_out_after_deadline)
+        # 見捨てたリクエストがタイムアウトして同時実行枠を返すまで待つ
+        time.sleep(0.6)
+        self.assertEqual(self.limiter.in_flight, 0)
+        self.assertEqual(self.limiter.failures, 0)
+        self.assertEqual(int(self.limiter.limit), 16)
+
+    def test_error_halves_limit(self):
+        for _ in range(20):
+            self.record('text', 1.0)
+        self.record('text', 1.0, ok=False)
+        self.assertEqual(int(self.limiter.limit), 8)
+
+
+if __name__ == '__main__':
+    unittest.main()
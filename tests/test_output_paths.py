@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""出力先ファイル名の確保（claim_output_paths）のテスト"""
+
+import logging
+import os
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import receipt_rename  # noqa: E402
+
+
+class ClaimOutputPathsTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.input_dir = self.temp_dir.name
+        self.source = os.path.join(self.input_dir, 'source.jpg')
+        with open(self.source, 'wb') as f:
+            f.write(b'receipt')
+        self.logger = logging.getLogger(__name__)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_identical_results_released_together_get_distinct_names(self):
+        # まとめての抽出で同じ結果が同時に返った場合を想定し、一斉に名前を確保する
+        workers = 6
+        barrier = threading.Barrier(workers)
+        claimed = []
+        lock = threading.Lock()
+
+        def worker():
+            barrier.wait()
+            paths = receipt_rename.claim_output_paths(
+                self.input_dir, '2024-01-05_1000円_ABC', '.jpg', self.source, True, self.logger)
+            with lock:
+                claimed.append(paths)
+
+        threads = [threading.Thread(target=worker) for _ in range(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        image_paths = sorted(os.path.basename(image_path) for image_path, _ in claimed)
+        self.assertEqual(image_paths, ['2024-01-05_1000円_ABC.jpg'] + [
+            f'2024-01-05_1000円_ABC_{n}.jpg' for n in range(1, workers)])
+        # テキストファイルは画像/PDFと同じ連番の名前になる
+        for image_path, text_path in claimed:
+            self.assertEqual(os.path.splitext(image_path)[0], os.path.splitext(text_path)[0])
+
+    def test_existing_text_file_moves_both_to_next_number(self):
+        open(os.path.join(self.input_dir, '2024-01-05_1000円_ABC.txt'), 'w').close()
+        image_path, text_path = receipt_rename.claim_output_paths(
+            self.input_dir, '2024-01-05_1000円_ABC', '.jpg', self.source, True, self.logger)
+        self.assertEqual(os.path.basename(image_path), '2024-01-05_1000円_ABC_1.jpg')
+        self.assertEqual(os.path.basename(text_path), '2024-01-05_1000円_ABC_1.txt')
+        self.assertFalse(os.path.exists(os.path.join(self.input_dir, '2024-01-05_1000円_ABC.jpg')))
+
+    def test_without_text_file(self):
+        image_path, text_path = receipt_rename.claim_output_paths(
+            self.input_dir, '2024-01-05_1000円_ABC', '.pdf', self.source, False, self.logger)
+        self.assertEqual(os.path.basename(image_path), '2024-01-05_1000円_ABC.pdf')
+        self.assertIsNone(text_path)
+
+
+if __name__ == '__main__':
+    unittest.main()